@@ -0,0 +1,251 @@
+import io
+import json
+import math
+
+import flask
+import numpy as np
+import pandas as pd
+
+from utils import NetworkFilter, gather, quantize
+
+################################################################################
+### JSON query API                                                           ###
+################################################################################
+# Upper limit of queries or nodes in one request.
+MAX_QUERIES = 1000
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+BOUNDS = {1: 1, 2: 2, 'lower': 1, 'upper': 2}
+
+class QueryError(Exception):
+    pass
+
+
+def make_api(store):
+    """
+    Blueprint with a JSON API on the loaded data, mounted at /api.
+
+    Results are tables, returned as JSON objects holding one list per column,
+    or as an Arrow IPC stream with format=arrow. Feature labels are used
+    wherever the web page uses them; the computations reuse the arrays of the
+    Dataset, exactly like the Network Visualization page.
+
+    GET  /api                    attributes and number of features.
+    POST /api/subgraphs          filtered neighborhoods of a batch of queries.
+    GET|POST /api/neighbors      neighbors of nodes, optionally thresholded.
+    GET|POST /api/matrix/<attr>  rows of a distance matrix.
+    """
+    api = flask.Blueprint('api', __name__, url_prefix='/api')
+
+    @api.errorhandler(QueryError)
+    def bad_query(e):
+        return flask.jsonify({'error': str(e)}), 400
+
+    @api.route('')
+    def describe():
+        data = store.data
+        return flask.jsonify({
+            'features': len(data.labels),
+            'edges': len(data.edges),
+            'attributes': data.edges.attributes,
+            'metadata': list(data.meta_dict),
+            'version': data.key,
+        })
+
+    @api.route('/subgraphs', methods=['POST'])
+    def subgraphs():
+        """
+        Body: {"queries": [{"nodes": [...], "degree": 1,
+                            "thresholds": {"lr": 25, "p": 0.05},
+                            "bounds": {"lr": "lower", "p": "upper"}}, ...]}
+
+        Each query is filtered as on the Network Visualization page; no nodes
+        means all nodes, attributes without a threshold are not filtered on
+        and bounds default to lower. "weight": attr and "radius": r replace
+        the degree by a distance in that attribute. Returns a "nodes" table (query, node,
+        focal) and an "edges" table (query, source, target and the value of
+        every attribute). With format=arrow, table=nodes|edges selects one.
+        """
+        data = store.data
+        queries = request_body().get('queries')
+        if not isinstance(queries, list) or not queries:
+            raise QueryError('"queries" must be a non-empty list.')
+        if len(queries) > MAX_QUERIES:
+            raise QueryError('At most {} queries per request.'.format(MAX_QUERIES))
+        node_tables, edge_tables = [], []
+        # One filter for the whole batch: a query differing from the previous one
+        # only in thresholds or degree is computed from its result.
+        network = NetworkFilter()
+        for i, query in enumerate(queries):
+            if not isinstance(query, dict):
+                raise QueryError('Query {} is not an object.'.format(i))
+            nodes = node_ids(data, query.get('nodes') or data.labels.names)
+            degree = query.get('degree', 1)
+            if not is_number(degree, int) or degree < 0:
+                raise QueryError('Query {}: "degree" must be a non-negative integer.'.format(i))
+            attributes, thresholds, bounds = criteria(data, query)
+            weight, radius = query.get('weight'), query.get('radius', 0)
+            if weight is not None and (not isinstance(weight, str) or weight not in data.edges.values):
+                raise QueryError("Query {0}: unknown weight '{1}'.".format(i, weight))
+            if not is_number(radius) or radius < 0:
+                raise QueryError('Query {}: "radius" must be a non-negative number.'.format(i))
+            network.update(data.edges, nodes, degree, attributes, thresholds, bounds, weight, radius)
+            node_tables.append(pd.DataFrame({
+                'query': i,
+                'node': data.labels.labels(network.nodes),
+                'focal': np.isin(network.nodes, network.focal),
+            }))
+            edge_tables.append(edge_table(data, network.edge_ids, query=i))
+        tables = {'nodes': pd.concat(node_tables, ignore_index=True),
+                  'edges': pd.concat(edge_tables, ignore_index=True)}
+        if wants_arrow():
+            name = flask.request.args.get('table', 'edges')
+            if name not in tables:
+                raise QueryError('"table" must be nodes or edges.')
+            return arrow_response(tables[name])
+        return json_response({name: columns(frame) for name, frame in tables.items()})
+
+    @api.route('/neighbors', methods=['GET', 'POST'])
+    def neighbors():
+        """
+        GET ?node=a&node=b, or POST {"nodes": [...], "thresholds": {...}, "bounds": {...}}.
+        Returns a table of node, neighbor and the value of every attribute,
+        for the edges passing the thresholds (all edges if none are given).
+        Self loops are left out.
+        """
+        data = store.data
+        if flask.request.method == 'GET':
+            query = {'nodes': flask.request.args.getlist('node')}
+        else:
+            query = request_body()
+        labels = query.get('nodes')
+        if not isinstance(labels, list) or not labels:
+            raise QueryError('Give at least one node.')
+        if len(labels) > MAX_QUERIES:
+            raise QueryError('At most {} nodes per request.'.format(MAX_QUERIES))
+        nodes = np.asarray(node_ids(data, labels), dtype=np.int64)
+        edges = data.edges
+        ids = gather(edges.ptr, edges.incident, nodes)
+        # the node each gathered edge was listed under
+        owner = np.repeat(nodes, edges.ptr[nodes + 1] - edges.ptr[nodes])
+        keep = edges.src[ids] != edges.dst[ids]
+        for attr, thresh, bound in zip(*criteria(data, query)):
+            v = edges.values[attr][ids]
+            keep &= v >= thresh if bound == 1 else v <= thresh
+        ids, owner = ids[keep], owner[keep]
+        other = np.where(edges.src[ids] == owner, edges.dst[ids], edges.src[ids])
+        frame = pd.DataFrame({'node': data.labels.labels(owner), 'neighbor': data.labels.labels(other)})
+        for attr in edges.attributes:
+            frame[attr] = edges.values[attr][ids]
+        return table_response(frame)
+
+    @api.route('/matrix/<attribute>', methods=['GET', 'POST'])
+    def matrix_rows(attribute):
+        """
+        GET ?node=a&node=b[&column=x&column=y], or POST {"nodes": [...], "columns": [...]}.
+        Returns the rows of the distance matrix for the given nodes, with a
+        "node" column followed by one column per requested feature (all
+        features if none are given).
+        """
+        data = store.data
+        if attribute not in data.dm_dict:
+            raise QueryError("Unknown attribute '{}'.".format(attribute))
+        if flask.request.method == 'GET':
+            query = {'nodes': flask.request.args.getlist('node'),
+                     'columns': flask.request.args.getlist('column')}
+        else:
+            query = request_body()
+        labels = query.get('nodes')
+        if not isinstance(labels, list) or not labels:
+            raise QueryError('Give at least one node.')
+        if len(labels) > MAX_QUERIES:
+            raise QueryError('At most {} nodes per request.'.format(MAX_QUERIES))
+        rows = node_ids(data, labels)
+        cols = node_ids(data, query.get('columns')) if query.get('columns') else np.arange(len(data.labels))
+        # Matrices are aligned to the node ids, so positions are node ids.
+        values = data.dm_dict[attribute].to_numpy()[np.ix_(rows, cols)]
+        frame = pd.DataFrame(values, columns=data.labels.labels(cols))
+        frame.insert(0, 'node', data.labels.labels(rows))
+        return table_response(frame)
+
+    return api
+
+
+def request_body():
+    body = flask.request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise QueryError('The request body must be a JSON object.')
+    return body
+
+def node_ids(data, labels):
+    if not isinstance(labels, list):
+        raise QueryError('Nodes must be given as a list.')
+    if not all(isinstance(label, str) for label in labels):
+        raise QueryError('Nodes must be given by their labels (strings).')
+    unknown = [label for label in labels if label not in data.labels]
+    if unknown:
+        raise QueryError('Unknown nodes: {}'.format(', '.join(map(str, unknown[:10]))))
+    return [data.labels.id(label) for label in labels]
+
+def is_number(value, types=(int, float)):
+    # JSON true and false arrive as bools, which are ints to Python; NaN and
+    # Infinity are accepted by the JSON parser but are no thresholds.
+    return isinstance(value, types) and not isinstance(value, bool) and math.isfinite(value)
+
+def criteria(data, query):
+    #Attributes, thresholds and bounds of a query, as NetworkFilter takes them.
+    thresholds = query.get('thresholds') or {}
+    bounds = query.get('bounds') or {}
+    if not isinstance(thresholds, dict) or not isinstance(bounds, dict):
+        raise QueryError('"thresholds" and "bounds" must be objects keyed by attribute.')
+    attributes = list(thresholds)
+    for attr in attributes:
+        if attr not in data.edges.values:
+            raise QueryError("Unknown attribute '{}'.".format(attr))
+        if not is_number(thresholds[attr]):
+            raise QueryError("Threshold of '{}' is not a number.".format(attr))
+        bound = bounds.get(attr, 1)
+        if not isinstance(bound, (str, int)) or isinstance(bound, bool) or bound not in BOUNDS:
+            raise QueryError("Bound of '{}' must be lower or upper.".format(attr))
+    return (attributes, [quantize(thresholds[attr]) for attr in attributes],
+            [BOUNDS[bounds.get(attr, 1)] for attr in attributes])
+
+def edge_table(data, edge_ids, query=None):
+    edges = data.edges
+    frame = pd.DataFrame({
+        'source': data.labels.labels(edges.src[edge_ids]),
+        'target': data.labels.labels(edges.dst[edge_ids]),
+    })
+    if query is not None:
+        frame.insert(0, 'query', query)
+    for attr in edges.attributes:
+        frame[attr] = edges.values[attr][edge_ids]
+    return frame
+
+def wants_arrow():
+    return (flask.request.args.get('format') == 'arrow' or
+            flask.request.accept_mimetypes.best == ARROW_MIMETYPE)
+
+def columns(frame):
+    #One list per column. NaN and infinite values become null, which JSON has no other way to express.
+    return {name: [v if math.isfinite(v) else None for v in frame[name].tolist()] if frame[name].dtype.kind == 'f'
+            else frame[name].tolist() for name in frame.columns}
+
+def json_response(obj):
+    # Not flask.jsonify, which sorts keys and so would reorder the columns.
+    return flask.Response(json.dumps(obj, allow_nan=False), mimetype='application/json')
+
+def table_response(frame):
+    if wants_arrow():
+        return arrow_response(frame)
+    return json_response(columns(frame))
+
+def arrow_response(frame):
+    try:
+        import pyarrow
+    except ImportError:
+        return flask.jsonify({'error': 'Arrow output requires pyarrow.'}), 406
+    table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return flask.Response(sink.getvalue(), mimetype=ARROW_MIMETYPE)
@@ -1,58 +1,133 @@
+import argparse
 import itertools as it
+import os
 import sys
+import tempfile
+import uuid
 from tempfile import NamedTemporaryFile
 
+# Heavy modules (plotly.express, dash_cytoscape, PIL) are imported where
+# they are used, so the server can start answering requests right away.
+
 import numpy as np
 import pandas as pd
 
 import dash
 from dash.dependencies import Output, Input, State
-from dash import dcc, dash_table, html, ALL
+from dash import dcc, dash_table, html, ALL, DiskcacheManager, Patch
+import diskcache
+import flask
 
 import dash_bootstrap_components as dbc
-import dash_cytoscape as cyto
-
-# Load extra layouts
-cyto.load_extra_layouts()
 
 import networkx as nx
 
-import plotly.graph_objects as go
-import plotly.express as px
+import plotly.colors
 
 from components import *
 from utils import *
+from metrics import CallbackMetrics, CallbackRecorder
+from datastore import DataStore
+from api import make_api
+from sessions import SessionStore
+from forksafe import fork_guard
+
+argparser = argparse.ArgumentParser(description='Launch the Indizio dashboard.')
+argparser.add_argument('samplesheet', help='Sample sheet file. Please use the included sample sheet maker to create it.')
+argparser.add_argument('--log-metrics', action='store_true', help='Print a structured (JSON) log line for every callback.')
+argparser.add_argument('--no-memory-metrics', action='store_true', help='Do not trace peak memory of callbacks. Tracing slows callbacks down.')
+argparser.add_argument('--record', metavar='FILE', help='Append every callback request to this file (JSON lines), to replay it with replay.py.')
+argparser.add_argument('--watch', type=float, metavar='SECONDS', help='Check the input files for changes at this interval and load changed files while the server keeps running.')
+argparser.add_argument('--max-elements', type=int, default=100000, help='Most nodes and edges shown in the network plot. Larger networks show their strongest edges.')
+argparser.add_argument('--session-cache-size', type=int, default=1024, help='Space (MB) for the results kept per browser session. The least recently used results are dropped beyond it.')
 
 if __name__ == '__main__':
 
+    args = argparser.parse_args()
+
+    # Long running callbacks are executed as background jobs in separate processes.
+    # Jobs report progress and share their results through an on-disk cache, so no
+    # external broker is required. Results are reused for identical inputs as long
+    # as the input files have not changed.
+    job_cache = diskcache.Cache(os.path.join(tempfile.gettempdir(), 'indizio-jobs'))
+
+    # The data are loaded in the background while the server starts.
+    # Clustering orders of the matrices are kept with the job results.
+    store = DataStore(args.samplesheet, cache=job_cache, watch=args.watch)
+    background_callback_manager = DiskcacheManager(job_cache, cache_by=[lambda: store.data.key], expire=60*60*24)
+    # For jobs whose result depends on what the session was shown before, and
+    # therefore must never be reused.
+    session_callback_manager = DiskcacheManager(job_cache, expire=60*60*24)
+    # Results of each browser session (filtered network, heatmap), see sessions.py.
+    sessions = SessionStore(tempfile.mkdtemp(prefix='indizio-sessions-'),
+                            size_limit=args.session_cache_size * 2**20)
+
     FONT_AWESOME = "https://use.fontawesome.com/releases/v5.7.2/css/all.css"
     external_stylesheets = [FONT_AWESOME, dbc.themes.JOURNAL,]
-    app = dash.Dash(__name__, external_stylesheets=external_stylesheets,suppress_callback_exceptions=True)
+    app = dash.Dash(__name__, external_stylesheets=external_stylesheets,suppress_callback_exceptions=True,
+                    background_callback_manager=background_callback_manager)
     server = app.server
-    colorscales=px.colors.named_colorscales()
-    try:
-        assert len(sys.argv) == 2
-    except:
-        raise ValueError('app.py accepts exactly one argument. Please use the included sample sheet maker to create the required file.')
-    #get the files
-    print("Parsing sample sheet. . .")
-    metas, dms, pa, tree = initialize_data(sys.argv[1])
-    #make the network
-    print("Initializing network. . . ")
-    G = make_graph(metas, dms)
-    node_items = [{'label': node, 'value': node} for node in G.nodes]
-    print("Done. Configuring dashboard. . .")
-    dm_metric_options = []
-
-    for i, tup in enumerate(dms):
-        dm_metric_options.append({
-            'label': tup[0],
-            'value': tup[0]
-        })
-    #dms is a list of tuples
-    dm_dict = {attr:frame for attr, frame in dms}
-    #metas is either list of tuples or empty list
-    meta_dict = {attr:frame for attr,frame in metas}
+    colorscales=plotly.colors.named_colorscales()
+    # Number of matching nodes offered in the node dropdown.
+    NODE_SEARCH_LIMIT = 50
+    # Seconds spent estimating betweenness, and nodes listed per centrality measure.
+    BETWEENNESS_BUDGET = 1.0
+    TOP_NODES = 5
+    # Large networks are sent to the browser in batches of this many elements,
+    # one every STREAM_INTERVAL milliseconds.
+    STREAM_BATCH = 2000
+    STREAM_INTERVAL = 250
+
+    # Per callback latency, memory and payload size, exposed at /metrics.
+    # A fresh directory per run so the counters start from zero.
+    metrics = CallbackMetrics(diskcache.Cache(tempfile.mkdtemp(prefix='indizio-metrics-')),
+                              log=args.log_metrics, trace_memory=not args.no_memory_metrics)
+
+    if args.record:
+        CallbackRecorder(args.record).register(server)
+
+    @server.route('/metrics')
+    def prometheus_metrics():
+        text = metrics.render() + '\n'.join([
+            '# HELP indizio_session_store_bytes Space used by the results kept per browser session.',
+            '# TYPE indizio_session_store_bytes gauge',
+            'indizio_session_store_bytes {}'.format(sessions.volume()),
+        ]) + '\n'
+        return flask.Response(text, mimetype='text/plain; version=0.0.4')
+
+    ################################################################################
+    ### Health checks                                                            ###
+    ################################################################################
+    # Liveness: the server answers. Readiness: the data are loaded.
+    health_paths = ('/healthz', '/readyz', '/metrics')
+
+    @server.route('/healthz')
+    def liveness():
+        if store.failed:
+            return flask.jsonify(store.report()), 500
+        return flask.jsonify({'status': 'alive'})
+
+    @server.route('/readyz')
+    def readiness():
+        return flask.jsonify(store.report()), 200 if store.ready else 503
+
+    @server.before_request
+    def loading_page():
+        # Until the data are loaded every page is a self refreshing status page.
+        if store.ready or flask.request.path in health_paths:
+            return None
+        report = store.report()
+        if flask.request.path.startswith('/api'):
+            return flask.jsonify(report), 503, {'Retry-After': '2'}
+        if store.failed:
+            page = make_loading_page('Loading the data failed: {}'.format(report['error']), refresh=False)
+        else:
+            page = make_loading_page('{0}. . . ({1:.0f} s)'.format(report['step'], report['elapsed_seconds']))
+        return flask.Response(page, status=503, headers={'Retry-After': '2'})
+
+    # JSON API for other tools, see api.py.
+    server.register_blueprint(make_api(store))
+
     default_stylesheet = [
                             {
                                 'selector':'edge',
@@ -84,6 +159,13 @@ if __name__ == '__main__':
                                 },
                             },
                             ]
+    # Coloring by community: the largest communities get a color of their own,
+    # all smaller ones are grey. Focal nodes keep a red border.
+    community_styles = [{'selector': 'node[community >= {}]'.format(len(plotly.colors.qualitative.Plotly)),
+                         'style': {'background-color': '#999999'}}] + \
+                       [{'selector': 'node[community = {}]'.format(i), 'style': {'background-color': color}}
+                        for i, color in enumerate(plotly.colors.qualitative.Plotly)] + \
+                       [{'selector': '.focal', 'style': {'border-color': '#E65340', 'border-width': 4}}]
 
 
 
@@ -92,14 +174,18 @@ if __name__ == '__main__':
     ################################################################################
 
     ### Entry Point. Also Serves as data dump for sharing between apps  ###
-    app.layout = html.Div([
-        dcc.Location(id='url', refresh=False),
-        #Stores for data persistence.
-        dcc.Store(id='graph-store'),
-
-        make_navbar(active=0),
-        html.Div(id='page-content'),
-    ])
+    def serve_layout():
+        # A function, so every page load gets its own session id.
+        return html.Div([
+            dcc.Location(id='url', refresh=False),
+            #Stores for data persistence.
+            # Only the session id: results are kept on the server, in `sessions`.
+            dcc.Store(id='graph-store', data={'session': uuid.uuid4().hex}),
+
+            make_navbar(active=0),
+            html.Div(id='page-content'),
+        ])
+    app.layout = serve_layout
 
     ### Landing Page ###
     #Adapted from https://getbootstrap.com/docs/4.0/examples/product/
@@ -137,8 +223,8 @@ if __name__ == '__main__':
             ]),
             html.Div(className="bg-primary mr-md-3 pt-3 px-3 pt-md-5 px-md-5 text-center text-white overflow-hidden",children=[
                 html.Div(className="my-3 py-3", children=[
-                    html.H2("(Not yet) View genome presence/absence cladogram.", className="display-5"),
-                    html.P('See the presence and absence of genes etc. in a per genome basis. (Not yet implemented).', className='lead'),
+                    html.H2("View genome presence/absence clustergram.", className="display-5"),
+                    html.P("See the presence and absence of genes etc. in a per genome basis, ordered by your tree. Click 'Clustergram'.", className='lead'),
 
                 ])
             ])
@@ -146,164 +232,252 @@ if __name__ == '__main__':
     ]
 
     ### Heat Map Viewer Layout ###
-    page1_layout = dbc.Container(fluid=True, children=[
-        dbc.Row(id='heatmap-display',children=[
-            dbc.Col([
-                dcc.Loading(dcc.Graph(id='heatmap-graph'),),
-            ],className='col-9'),
-
-            dbc.Col(
-                [
-                dbc.Row([
-                    dbc.Col([
-                        html.Div([
-                            dbc.Label("Choose Metric"),
-                            dcc.Dropdown(
-                                id="dataset-select", value=dm_metric_options[0]['value'],
-                                options=dm_metric_options,
-                            ),
-                    ],className='pl-5 pr-5'),
-                        ],),
-                    ]),
+    def make_page1_layout(data):
+        return dbc.Container(fluid=True, children=[
+            dbc.Row(id='heatmap-display',children=[
+                dbc.Col([
+                    dcc.Loading(dcc.Graph(id='heatmap-graph'),),
+                ],className='col-9'),
+
+                dbc.Col(
+                    [
                     dbc.Row([
-                    html.P("Color Scale"),
-                    dcc.Dropdown(
-                        id='colorscale',
-                        options=[{"value": x, "label": x}
-                                 for x in colorscales],
-                        value='inferno'
-                    ),]),
-                    dbc.RadioItems(
-                        options=[
-                            {"label": "Continuous", "value": 1},
-                            {"label": "Binned", "value": 2},
-                        ],
-                        value=1,
-                        id="plot-mode-radio", inline=True,
-                    ),
-                    dbc.Row([
-                        dbc.Button(html.Span([html.I(className="fas fa-minus-circle ml-2")]), className='col col-1',id='minus-button' ),
-                        dbc.Button(html.Span([html.I(className="fas fa-plus-circle ml-2")]), className='col col-1', id='plus-button'),
-                        dbc.Col(id='slider-container',
-                            children=[
-                                dcc.RangeSlider(min=0,max=0)
-                            ]
+                        dbc.Col([
+                            html.Div([
+                                dbc.Label("Choose Metric"),
+                                dcc.Dropdown(
+                                    id="dataset-select", value=data.dm_metric_options[0]['value'],
+                                    options=data.dm_metric_options,
+                                ),
+                        ],className='pl-5 pr-5'),
+                            ],),
+                        ]),
+                        dbc.Row([
+                        html.P("Color Scale"),
+                        dcc.Dropdown(
+                            id='colorscale',
+                            options=[{"value": x, "label": x}
+                                     for x in colorscales],
+                            value='inferno'
+                        ),]),
+                        dbc.RadioItems(
+                            options=[
+                                {"label": "Continuous", "value": 1},
+                                {"label": "Binned", "value": 2},
+                            ],
+                            value=1,
+                            id="plot-mode-radio", inline=True,
                         ),
-                    ]),
-                    dbc.Button('Update Heatmap', id='heatmap-button', color='secondary'),
-                ]
-            ),
+                        dbc.RadioItems(
+                            options=[
+                                {"label": "File order", "value": 1},
+                                {"label": "Clustered", "value": 2},
+                            ],
+                            value=1,
+                            id="heatmap-order-radio", inline=True,
+                        ),
+                        dbc.RadioItems(
+                            options=[
+                                {"label": "All features", "value": 'all'},
+                                {"label": "Network nodes", "value": 'network'},
+                                {"label": "Search", "value": 'search'},
+                            ],
+                            value='all',
+                            id="heatmap-subset-radio", inline=True,
+                        ),
+                        dbc.Input(id='heatmap-search', placeholder='Features containing . . .', type='text', value=''),
+                        dbc.Row([
+                            dbc.Button(html.Span([html.I(className="fas fa-minus-circle ml-2")]), className='col col-1',id='minus-button' ),
+                            dbc.Button(html.Span([html.I(className="fas fa-plus-circle ml-2")]), className='col col-1', id='plus-button'),
+                            dbc.Col(id='slider-container',
+                                children=[
+                                    dcc.RangeSlider(min=0,max=0)
+                                ]
+                            ),
+                        ]),
+                        dbc.Button('Update Heatmap', id='heatmap-button', color='secondary'),
+                    ]
+                ),
+            ])
         ])
-    ])
 
 
     ### Network viz layout ###
-    page2_layout = dbc.Container(fluid=True, children=[
-        dbc.Row([
+    def make_page2_layout(data):
+        import dash_cytoscape as cyto
+        return dbc.Container(fluid=True, children=[
             dbc.Row([
-                html.H3(children="Network Visualization"),
-                dbc.Col(children=[
-                    dbc.Row(children=[
-                        html.Div([
-                            dbc.Label("Change network Layout"),
-                            dcc.Dropdown(
-                                id='network-callbacks-1',
-                                value='grid',
-                                clearable=False,
-                                options=[
-                                    {'label': name.capitalize(), 'value': name}
-                                    #for name in ['grid', 'random', 'circle', 'cose', 'concentric', 'breadthfirst']
-                                    for name in [
-                                        'random',
-                                        'grid',
-                                        'circle',
-                                        'concentric',
-                                        'breadthfirst',
-                                        'cose',
-                                        'cose-bilkent',
-                                        'cola',
-                                        'klay',
-                                        'spread',
-                                        'euler'
-                                    ]
-                                ], className="bg-light text-dark",
-                            ),
-                            ]),
-                        html.Div([
-                            dbc.Col([
-                                dbc.Label('Select a node of interest.'),
+                dbc.Row([
+                    html.H3(children="Network Visualization"),
+                    dbc.Col(children=[
+                        dbc.Row(children=[
+                            html.Div([
+                                dbc.Label("Change network Layout"),
                                 dcc.Dropdown(
-                                    id='node-dropdown',
-                                    options=node_items,
-                                    value=[],
-                                    className="bg-light text-dark",
-                                    multi=True),
+                                    id='network-callbacks-1',
+                                    value='grid',
+                                    clearable=False,
+                                    options=[
+                                        {'label': name.capitalize(), 'value': name}
+                                        #for name in ['grid', 'random', 'circle', 'cose', 'concentric', 'breadthfirst']
+                                        for name in [
+                                            'random',
+                                            'grid',
+                                            'circle',
+                                            'concentric',
+                                            'breadthfirst',
+                                            'cose',
+                                            'cose-bilkent',
+                                            'cola',
+                                            'klay',
+                                            'spread',
+                                            'euler'
+                                        ]
+                                    ], className="bg-light text-dark",
+                                ),
+                                dbc.Label("Color nodes by"),
+                                dbc.RadioItems(
+                                    id='node-color-select',
+                                    options=[
+                                        {'label': 'Focal or not', 'value': 'focal'},
+                                        {'label': 'Community', 'value': 'community'},
+                                    ],
+                                    value='focal',
+                                    inline=True,
+                                ),
+                                ]),
+                            html.Div([
+                                dbc.Col([
+                                    dbc.Label('Select a node of interest.'),
+                                    dcc.Dropdown(
+                                        id='node-dropdown',
+                                        # filled by search_nodes as the user types
+                                        options=[],
+                                        value=[],
+                                        className="bg-light text-dark",
+                                        multi=True),
 
+                                ]),
+
+                                dbc.Col(make_network_form(data.dm_dict.keys())),
                             ]),
 
-                            dbc.Col(make_network_form(dm_dict.keys())),
+                            html.Div([dbc.Button('Update Network', id='interactive-button', color='success', style={'margin-bottom': '1em'},)],className="d-grid gap-2"),
+                            html.Div([dbc.Progress(id='network-progress', value=0, max=1, striped=True, animated=True, style={'margin-bottom': '1em'})]),
+                            # Version of the elements the network plot holds, None until the first update.
+                            dcc.Store(id='network-version'),
+                            # Fetches the rest of a large network after the first batch, see stream_elements.
+                            dcc.Interval(id='network-stream', interval=STREAM_INTERVAL, disabled=True),
+                            html.Div([dbc.Button('Download as GraphML', id='download-network-button', color='success', style={'margin-bottom': '1em'},), dcc.Download(id='download-network')],className="d-grid gap-2"),
+
                         ]),
 
-                        html.Div([dbc.Button('Update Network', id='interactive-button', color='success', style={'margin-bottom': '1em'},)],className="d-grid gap-2"),
-                        html.Div([dbc.Button('Download as GraphML', id='download-network-button', color='success', style={'margin-bottom': '1em'},), dcc.Download(id='download-network')],className="d-grid gap-2"),
+                        dbc.Row(
 
+                                children=dbc.Card(
+                                    [
+                                        dbc.CardHeader("Network Properties", className="bg-primary text-white"),
+                                        dbc.CardBody(
+                                            html.P("Lorem Ipsum and all that.", className='card-text text-dark',
+                                            id='node-selected')
+                                        )
+                                    ]
+                                )
+                        ),
                     ]),
+                    dbc.Col(children=[
+                        #dbc.Col(dcc.Graph(id='interactive-graph')),  # Not including fig here because it will be generated with the callback
+                        dbc.Col(cyto.Cytoscape(
+                            id='network-plot',
+                            elements=[],
+                            stylesheet=default_stylesheet,
+                            style={'width': '100%', 'height': '800px'},
+                            layout={
+                                'name': 'grid'
+                            },
+                        ),className='bg-white'),
 
-                    dbc.Row(
+                    ], className='col col-xl-9 col-lg-8 col-md-6 '),
+                ], className='bg-secondary text-white')
+            ]),
+        ])
 
-                            children=dbc.Card(
-                                [
-                                    dbc.CardHeader("Network Properties", className="bg-primary text-white"),
-                                    dbc.CardBody(
-                                        html.P("Lorem Ipsum and all that.", className='card-text text-dark',
-                                        id='node-selected')
-                                    )
-                                ]
-                            )
+    def make_page3_layout(data):
+        return dbc.Container(fluid=True, children=[
+            dbc.Row(id='historgram-display',children=[
+                dbc.Col([
+                    dcc.Loading(dcc.Graph(id='histogram-graph'),),
+                    dbc.Row([
+                        dbc.Col([
+                            html.Div([
+                            dbc.Row([
+                                dbc.Col([
+                                    html.Div([
+                                        dbc.Label("Choose Metric"),
+                                        dcc.Dropdown(
+                                            id="histogram-metric-select", value=data.dm_metric_options[0]['value'],
+                                            options=data.dm_metric_options,
+                                        ),
+                                ],className='pl-5 pr-5'),
+                                    ],),
+                                ]),
+                                html.Div([dbc.Button('Re-calculate Plot', id='histogram-button', color='primary', style={'margin-bottom': '1em'})],className="d-grid gap-2"),
+                                html.Div([dbc.Button('Cancel', id='histogram-cancel-button', color='secondary', disabled=True, style={'margin-bottom': '1em'})],className="d-grid gap-2"),
+                                html.Div([dbc.Progress(id='histogram-progress', value=0, max=1, striped=True, animated=True, style={'margin-bottom': '1em'})]),
+                            ]),
+                        ],className='pl-5 pr-5'),
+                    ],),
+                ]),
+            ]),
+            # Network connectivity at every threshold of one metric.
+            dbc.Row(id='percolation-display', children=[
+                dbc.Col([
+                    dcc.Loading(dcc.Graph(id='percolation-graph'),),
+                ], className='col-9'),
+                dbc.Col([
+                    dbc.Label("Choose Metric"),
+                    dcc.Dropdown(
+                        id="percolation-metric-select", value=data.dm_metric_options[0]['value'],
+                        options=data.dm_metric_options,
+                    ),
+                    dbc.RadioItems(
+                        options=[
+                            {'label': "Lower Bound", "value": 1},
+                            {'label': "Upper Bound", "value": 2},
+                        ],
+                        value=1,
+                        id="percolation-bounds-select",
+                        inline=True,
                     ),
+                    html.Div([dbc.Button('Calculate Threshold Curves', id='percolation-button', color='primary', style={'margin-bottom': '1em'})],className="d-grid gap-2"),
+                    html.Div([dbc.Progress(id='percolation-progress', value=0, max=1, striped=True, animated=True, style={'margin-bottom': '1em'})]),
                 ]),
-                dbc.Col(children=[
-                    #dbc.Col(dcc.Graph(id='interactive-graph')),  # Not including fig here because it will be generated with the callback
-                    dbc.Col(cyto.Cytoscape(
-                        id='network-plot',
-                        elements=[],
-                        stylesheet=default_stylesheet,
-                        style={'width': '100%', 'height': '800px'},
-                        layout={
-                            'name': 'grid'
-                        },
-                    ),className='bg-white'),
-
-                ], className='col col-xl-9 col-lg-8 col-md-6 '),
-            ], className='bg-secondary text-white')
-        ]),
-    ])
+            ]),
+        ])
 
-    page3_layout = dbc.Container(fluid=True, children=[
-        dbc.Row(id='historgram-display',children=[
-            dbc.Col([
-                dcc.Loading(dcc.Graph(id='histogram-graph'),),
-                dbc.Row([
-                    dbc.Col([
-                        html.Div([
-                        dbc.Row([
-                            dbc.Col([
-                                html.Div([
-                                    dbc.Label("Choose Metric"),
-                                    dcc.Dropdown(
-                                        id="histogram-metric-select", value=dm_metric_options[0]['value'],
-                                        options=dm_metric_options,
-                                    ),
-                            ],className='pl-5 pr-5'),
-                                ],),
-                            ]),
-                            html.Div([dbc.Button('Re-calculate Plot', id='histogram-button', color='primary', style={'margin-bottom': '1em'})],className="d-grid gap-2"),
-                        ]),
-                    ],className='pl-5 pr-5'),
-                ],),
+    ### Clustergram layout ###
+    def make_page4_layout(data):
+        if data.tree is None or data.pa is None:
+            return dbc.Container(fluid=True, children=[
+                html.P("A clustergram needs both a tree and a presence/absence table in the sample sheet.",
+                       className='lead p-5'),
+            ])
+        return dbc.Container(fluid=True, children=[
+            dbc.Row(id='clustergram-display', children=[
+                dbc.Col([
+                    dcc.Loading(dcc.Graph(id='clustergram-graph'),),
+                ], className='col-9'),
+                dbc.Col([
+                    html.P("Color Scale"),
+                    dcc.Dropdown(
+                        id='clustergram-colorscale',
+                        options=[{"value": x, "label": x}
+                                 for x in colorscales],
+                        value='greys'
+                    ),
+                ]),
             ]),
-        ]),
-    ])
+        ])
 
 
 
@@ -315,7 +489,7 @@ if __name__ == '__main__':
         [Input('dataset-select', 'value')]
     )
     def update_colorscale_slider(metric):
-        df = dm_dict[metric]
+        df = store.data.dm_dict[metric]
         maxval = np.nanmax(df.values)
         minval = np.nanmin(df.values)
         slider = dcc.RangeSlider(min=minval, max=maxval,
@@ -363,18 +537,40 @@ if __name__ == '__main__':
          State('dataset-select', 'value'),
          State('colorscale', 'value'),
          State('plot-mode-radio', "value"),
-         State({'role': 'slider', 'index': ALL}, 'value')]
+         State('heatmap-order-radio', "value"),
+         State('heatmap-subset-radio', "value"),
+         State('heatmap-search', "value"),
+         State({'role': 'slider', 'index': ALL}, 'value'),
+         State('graph-store', 'data')]
     )
-    def plot(click, dataset, scale, mode, slidervals):
-
-        fig = go.Figure()
-        #empty initially
-
-        feature_df = dm_dict[dataset]
+    @metrics.instrument('plot')
+    def plot(click, dataset, scale, mode, order_mode, subset_mode, search, slidervals, graph_store):
+
+        data = store.data
+        session = graph_store['session']
+        # Positions (= node ids) of the features to show, None for all of them.
+        subset, subset_title = None, None
+        if subset_mode == 'network':
+            state = sessions.get(session, 'network')
+            if state is not None and state['data'] == data.key:
+                subset = state['network'].nodes
+                subset_title = '{} features of the network'.format(len(subset))
+            else:
+                subset_title = 'No network shown yet, showing all features.'
+        elif subset_mode == 'search' and search:
+            subset = np.array(data.labels.ids(data.label_index.search(search, limit=len(data.labels))), dtype=np.int64)
+            subset_title = "{0} features containing '{1}'".format(len(subset), search)
+        # Coming back to the page redraws the last heatmap, which is kept for the session.
+        query = [data.key, dataset, scale, mode, order_mode, slidervals, data.orders.get(dataset) is not None,
+                 subset_title, None if subset is None else subset.tolist()]
+        last = sessions.get(session, 'heatmap')
+        if last is not None and last['query'] == query:
+            return last['figure']
+        feature_df = data.dm_dict[dataset]
         meta_df = None
 
-        if dataset in meta_dict.keys():
-            meta_df = meta_dict[dataset]
+        if dataset in data.meta_dict.keys():
+            meta_df = data.meta_dict[dataset]
         if len(slidervals) == 0:
             slidervals = [np.nanmin(feature_df.values), np.nanmax(feature_df.values)]
         else:
@@ -392,68 +588,38 @@ if __name__ == '__main__':
         else:
             colorscale = scale
 
-        ava_hm = go.Heatmap(x=feature_df.columns,
-                            y=feature_df.index,
-                            z=feature_df,
-                            colorscale=colorscale,
-                            zmin=slidervals[0],
-                            zmax=slidervals[-1],
-                            #colorbar=colorbar,
-                           )
-        if type(meta_df) != type(None):
-            meta_hm = go.Heatmap(x=meta_df.columns,
-                                 y=meta_df.index,
-                                 z=meta_df,
-                                 colorscale=colorscale,
-                                 zmin=slidervals[0],
-                                 zmax=slidervals[-1],
-                                 showscale=False
-            )
-            f1 = go.Figure(meta_hm)
-            for data in f1.data:
-                fig.add_trace(data)
-
-            f2 = go.Figure(ava_hm)
-            for i in range(len(f2['data'])):
-                f2['data'][i]['xaxis'] = 'x2'
-
-            for data in f2.data:
-                fig.add_trace(data)
-
-            fig.update_layout({'height':800})
-            fig.update_layout(xaxis={'domain': [.0, .20],
-                                              'mirror': False,
-                                              'showgrid': False,
-                                              'showline': False,
-                                              'zeroline': False,
-                                              #'ticks':"",
-                                              #'showticklabels': False
-                                    })
-            # Edit xaxis2
-            fig.update_layout(xaxis2={'domain': [0.25, 1.0],
-                                               'mirror': False,
-                                               'showgrid': False,
-                                               'showline': False,
-                                               'zeroline': False,
-                                               #'showticklabels': False,
-                                               #'ticks':""
-                                     })
-        else:
-            f = go.Figure(ava_hm)
-            for data in f.data:
-                fig.add_trace(data)
-            fig.update_layout({'height':800})
-            fig.update_layout(xaxis={'mirror': False,
-                                     'showgrid': False,
-                                     'showline': False,
-                                     'zeroline': False,
-                                     'tickmode': 'array',
-                                     'ticktext': feature_df.columns.str.slice(-8).tolist()})
+        title = subset_title
+        order = None
+        if order_mode == 2:
+            # Computed in the background after loading, see DataStore.
+            order = data.orders.get(dataset)
+            if order is None:
+                title = 'Clustering is not available yet, showing file order.'
+        with metrics.phase('slicing'):
+            feature_df, meta_df = reorder(feature_df, meta_df, order, subset)
+
+        with metrics.phase('layout'):
+            fig = make_heatmap_figure(feature_df, meta_df, colorscale, slidervals[0], slidervals[-1])
+            if title:
+                fig.update_layout(title=title)
+        sessions.put(session, 'heatmap', {'query': query, 'figure': fig})
         return fig
 
     ################################################################################
     ### Network Visualization Callbacks                                          ###
     ################################################################################
+    @app.callback(
+        Output('node-dropdown', 'options'),
+        Input('node-dropdown', 'search_value'),
+        State('node-dropdown', 'value'),
+    )
+    def search_nodes(search, selected):
+        # Only the best matches are sent, so the page size does not grow with the graph.
+        selected = selected or []
+        matches = store.data.label_index.search(search, limit=NODE_SEARCH_LIMIT)
+        return [{'label': node, 'value': node} for node in selected] + \
+               [{'label': node, 'value': node} for node in matches if node not in selected]
+
     @app.callback(
         Output('network-plot', 'layout'),
         Input('network-callbacks-1', 'value')
@@ -470,66 +636,216 @@ if __name__ == '__main__':
         State('degree', 'value'),
         State({'role': 'threshold', 'index': ALL}, 'value'),
         State({'role': 'bounds-select', 'index': ALL}, 'value'),
+        State('neighborhood-weight', 'value'),
+        State('radius', 'value'),
+        State('graph-store', 'data'),
         ]
     )
-    def download_network(click, nodes, degree, thresholds, bounds):
-        n_nodes = 0
-        n_edges = 0
-        attributes = list(dm_dict.keys())
+    @metrics.instrument('download_network')
+    def download_network(click, nodes, degree, thresholds, bounds, weight, radius, graph_store):
+        data = store.data
+        attributes = list(data.dm_dict.keys())
+        weight = weight or None
         H=None
         if len(nodes) == 0:
             elements = []
         else:
-            H = filter_graph(G, nodes, degree, attributes, thresholds, bounds)
+            with metrics.phase('filtering'):
+                ids = data.labels.ids(nodes)
+                # Usually the network on screen, which the session already holds.
+                state = sessions.get(graph_store['session'], 'network')
+                if state is not None and state['data'] == data.key and \
+                        state['network'].same_query(ids, degree, attributes, thresholds, bounds, weight, radius):
+                    network = state['network']
+                else:
+                    network = NetworkFilter()
+                    network.update(data.edges, ids, degree, attributes, thresholds, bounds, weight, radius)
+                H = network.to_networkx(data.edges)
+                communities = network_analysis(data, network, 'communities', detect_communities)
+                nx.set_node_attributes(H, dict(zip(network.nodes.tolist(), communities.tolist())), 'community')
         if H:
             nfile = NamedTemporaryFile('w')
             #nfile.name = 'tmp/network.graphml' TODO how can i change the name of this file?
-            nx.readwrite.graphml.write_graphml(H, nfile.name)
-            return dcc.send_file(nfile.name)
+            with metrics.phase('export'):
+                nx.readwrite.graphml.write_graphml(data.labels.relabel(H), nfile.name)
+                data = dcc.send_file(nfile.name)
+            return data
         return dash.no_update
+
+    def network_analysis(data, network, name, compute):
+        #compute(nodes, src, dst) for the nodes and edges shown. Cached by them,
+        #so all sessions and the GraphML download share the result of a query.
+        key = (name, data.key, network.fingerprint())
+        with fork_guard:
+            result = job_cache.get(key)
+        if result is None:
+            ids = network.edge_ids
+            result = compute(network.nodes, data.edges.src[ids], data.edges.dst[ids])
+            with fork_guard:
+                job_cache.set(key, result, expire=60*60*24)
+        return result
+
+    def top_nodes(data, network, values):
+        top = np.argsort(-values, kind='stable')[:TOP_NODES]
+        return ', '.join('{0} ({1:.3g})'.format(data.labels.names[network.nodes[i]], values[i]) for i in top)
+
     @app.callback(
         Output('network-plot', 'elements'),
         Output('node-selected', 'children'),
+        Output('network-version', 'data'),
+        Output('network-stream', 'disabled'),
         [Input('interactive-button', 'n_clicks'),
          State('node-dropdown', 'value'),
          State('degree', 'value'),
          State({'role': 'threshold', 'index': ALL}, 'value'),
-         State({'role': 'bounds-select', 'index': ALL}, 'value'),]
+         State({'role': 'bounds-select', 'index': ALL}, 'value'),
+         State('neighborhood-weight', 'value'),
+         State('radius', 'value'),
+         State('stream-attribute', 'value'),
+         State('graph-store', 'data'),
+         State('network-version', 'data'),],
+        background=True,
+        # The response is a change to what this session shows, so it is never reused.
+        manager=session_callback_manager,
+        progress=[Output('network-progress', 'value'), Output('network-progress', 'max')],
+        running=[(Output('interactive-button', 'disabled'), True, False)],
+        # A new node selection makes the running job obsolete.
+        cancel=[Input('node-dropdown', 'value')],
     )
-    def update_elements(click, nodes, degree, thresholds, bounds):
-        n_nodes = 0
-        n_edges = 0
-        attributes = list(dm_dict.keys())
+    @metrics.instrument('update_elements')
+    def update_elements(set_progress, click, nodes, degree, thresholds, bounds, weight, radius, strongest, graph_store, version):
+        data = store.data
+        attributes = list(data.dm_dict.keys())
+        # '' selects the hop count
+        weight = weight or None
         if len(nodes) == 0:
-            nodes = [i['value'] for i in node_items]
-        #else:
-        H = filter_graph(G, nodes, degree, attributes, thresholds, bounds)
-        # Graph basics
-        elements = nx_to_dash(H, nodes)
-        n_nodes = len(H.nodes)
-        n_edges = len(H.edges)
-        #end else
+            nodes = data.labels.names
+        session = graph_store['session']
+        with sessions.lock(session, 'network-stream'):
+            stream = sessions.get(session, 'network-stream')
+            if stream is not None and stream['pending']:
+                # stops the stream of the previous network
+                sessions.put(session, 'network-stream', dict(stream, pending=[]))
+        set_progress((0, 4))
+        with metrics.phase('filtering'):
+            # The previous query of this session, so a moved threshold or degree only updates its result.
+            state = sessions.get(session, 'network')
+            network = state['network'] if state is not None and state['data'] == data.key else NetworkFilter()
+            network.update(data.edges, data.labels.ids(nodes), degree, attributes, thresholds, bounds, weight, radius)
+            sessions.put(session, 'network', {'data': data.key, 'network': network})
+        set_progress((1, 4))
+        with metrics.phase('communities'):
+            communities = network_analysis(data, network, 'communities', detect_communities)
+        set_progress((2, 4))
+        with metrics.phase('centrality'):
+            centrality, sources = network_analysis(
+                data, network, 'centrality',
+                lambda nodes, src, dst: centralities(nodes, src, dst, budget=BETWEENNESS_BUDGET))
+        set_progress((3, 4))
+        with metrics.phase('layout'):
+            # Strongest edges first, so the first batch shows the core of the network.
+            strongest = strongest if strongest in attributes else attributes[0]
+            keys = stream_order(network.element_keys(communities), data.edges, strongest,
+                                bounds[attributes.index(strongest)])
+            n_elements = len(keys)
+            keys = keys[:args.max_elements]
+            # Only what changed since the elements last sent to this session is
+            # sent. The stream is locked from here until the new elements are
+            # recorded, so no batch of it slips in between.
+            with sessions.lock(session, 'network-stream'):
+                stream = sessions.get(session, 'network-stream')
+                if stream is None or stream['data'] != data.key:
+                    stream = {'data': data.key, 'keys': [], 'pending': [], 'version': None}
+                removed, added = diff_elements(stream['keys'], keys)
+                if version is None or version != stream['version'] or len(removed) + len(added) >= len(keys):
+                    # The plot holds something else (e.g. the page was reloaded), or little is left over.
+                    removed, held, added = None, [], keys
+                else:
+                    gone = set(removed)
+                    held = [k for i, k in enumerate(stream['keys']) if i not in gone]
+                    # Nodes whose data changed are replaced at once; removing a node
+                    # from the plot would also remove its edges.
+                    replaced = {stream['keys'][i][1] for i in removed if stream['keys'][i][0] == 'node'}
+                    added = [k for k in added if k[0] == 'node' and k[1] in replaced] + \
+                            [k for k in added if k[0] != 'node' or k[1] not in replaced]
+                batch, pending = added[:STREAM_BATCH], added[STREAM_BATCH:]
+                stream = {'data': data.key, 'keys': held + batch, 'pending': pending, 'version': uuid.uuid4().hex}
+                sessions.put(session, 'network-stream', stream)
+            if removed is None:
+                elements = make_elements(batch, data.edges, data.labels)
+            elif removed or batch:
+                elements = Patch()
+                for i in reversed(removed):
+                    del elements[i]
+                elements.extend(make_elements(batch, data.edges, data.labels))
+            else:
+                elements = dash.no_update
+        set_progress((4, 4))
+        n_nodes = len(network.nodes)
+        n_edges = len(network.edge_ids)
         summary_data = [
             dbc.ListGroupItem("Focal Node: {}".format(nodes)),
-            dbc.ListGroupItem("Degree: {}".format(degree)),
+            dbc.ListGroupItem("Degree: {}".format(degree) if weight is None else
+                              "Radius: {0} in {1}".format(radius or 0, weight)),
         ]
         for attr, thresh in zip(attributes, thresholds):
             summary_data.append(
                 dbc.ListGroupItem("{0} threshold: {1}".format(attr, thresh)),
             )
         summary_data += [dbc.ListGroupItem("n Nodes: {}".format(n_nodes)),
-                         dbc.ListGroupItem("n Edges: {}".format(n_edges)),]
+                         dbc.ListGroupItem("n Edges: {}".format(n_edges)),
+                         dbc.ListGroupItem("n Communities: {}".format(communities.max() + 1 if len(communities) else 0)),]
+        if n_elements > len(keys):
+            summary_data.append(dbc.ListGroupItem("Plot limited to the {0} strongest of {1} nodes and edges by {2}".format(
+                len(keys), n_elements, strongest)))
+        if n_nodes:
+            summary_data += [dbc.ListGroupItem("Top degree: {}".format(top_nodes(data, network, centrality['degree']))),
+                             dbc.ListGroupItem("Top betweenness{0}: {1}".format(
+                                 '' if sources == n_nodes else ' (estimated from {} nodes)'.format(sources),
+                                 top_nodes(data, network, centrality['betweenness']))),
+                             dbc.ListGroupItem("Top eigenvector centrality: {}".format(top_nodes(data, network, centrality['eigenvector']))),]
         #summary = html.P("Focal Node: {0}\nDegree: {1}<br>LR Threshold: {2}<br>P Threshold: {3}<br>Nodes in selection: {4}<br>Edges in selection: {5}".format(node, degree, lr_threshold, p_threshold,n_nodes, n_edges))
         summary = dbc.ListGroup(
             summary_data,
         )
-        return elements, summary
+        return elements, summary, stream['version'], not pending
+
+    @app.callback(
+        Output('network-plot', 'elements', allow_duplicate=True),
+        Output('network-version', 'data', allow_duplicate=True),
+        Output('network-stream', 'disabled', allow_duplicate=True),
+        Input('network-stream', 'n_intervals'),
+        State('graph-store', 'data'),
+        State('network-version', 'data'),
+        prevent_initial_call=True,
+    )
+    @metrics.instrument('stream_elements')
+    def stream_elements(n_intervals, graph_store, version):
+        #Sends the next batch of the elements update_elements left pending.
+        data = store.data
+        session = graph_store['session']
+        # Only the small stream entry is touched, under the lock update_elements also takes.
+        with sessions.lock(session, 'network-stream'):
+            stream = sessions.get(session, 'network-stream')
+            if stream is None or stream['data'] != data.key or stream['version'] != version or not stream['pending']:
+                # finished, or the plot moved on to another network
+                return dash.no_update, dash.no_update, True
+            batch = stream['pending'][:STREAM_BATCH]
+            stream = {'data': data.key, 'keys': stream['keys'] + batch,
+                      'pending': stream['pending'][STREAM_BATCH:], 'version': uuid.uuid4().hex}
+            sessions.put(session, 'network-stream', stream)
+        elements = Patch()
+        elements.extend(make_elements(batch, data.edges, data.labels))
+        return elements, stream['version'], not stream['pending']
 
     @app.callback(Output('network-plot', 'stylesheet'),
-                [Input('network-plot', 'tapNode')])
-    def highlight_edges(node):
+                [Input('network-plot', 'tapNode'),
+                 Input('node-color-select', 'value')])
+    @metrics.instrument('highlight_edges')
+    def highlight_edges(node, color_mode):
+        colors = community_styles if color_mode == 'community' else []
         if not node:
-            return default_stylesheet
+            return default_stylesheet + colors
 
         stylesheet = [
                             {
@@ -562,6 +878,7 @@ if __name__ == '__main__':
                                     'content': 'data(label)',
                                 },
                             },
+                            *colors,
                             {
                                 "selector": 'node[id = "{}"]'.format(node['data']['id']),
                                 "style": {
@@ -613,9 +930,17 @@ if __name__ == '__main__':
         Output('histogram-graph', 'figure'),
         [Input('histogram-button', 'n_clicks'),
         State('histogram-metric-select', 'value'),
-        State('histogram-y-select', 'value')]
+        State('histogram-y-select', 'value')],
+        background=True,
+        progress=[Output('histogram-progress', 'value'), Output('histogram-progress', 'max')],
+        running=[(Output('histogram-button', 'disabled'), True, False),
+                 (Output('histogram-cancel-button', 'disabled'), False, True)],
+        cancel=[Input('histogram-metric-select', 'value'),
+                Input('histogram-cancel-button', 'n_clicks')],
+        cache_args_to_ignore=[0],
     )
-    def show_histogram(click, metric_sel, y_sel):
+    @metrics.instrument('show_histogram')
+    def show_histogram(set_progress, click, metric_sel, y_sel):
         metric_map = {
                         '1': ('lr', 'p'),
                         '2': ('p', 'lr')
@@ -629,58 +954,51 @@ if __name__ == '__main__':
         y = y_map[str(y_sel)]
 
 
-        lte = lambda x,y: x<=y
-        gte = lambda x,y: x>=y
-
-        if dynamic_metric == 'lr':
-            search = [25, 50, 100, 150]
-            dfun = gte
-            sfun = lte
+        with metrics.phase('filtering'):
+            rdf = threshold_statistics(store.data.G, dynamic_metric, static_metric,
+                                       progress=lambda done, total: set_progress((done, total)))
+            rdf['node'] = store.data.labels.labels(rdf['node'])
+        import plotly.express as px
+        with metrics.phase('layout'):
+            plot = px.histogram(rdf, x='node', y=y, facet_col=dynamic_metric)
+            plot.update_layout({'height':800})
+        return plot
 
-        else:
-            search = [0.05, 1e-5, 1e-9, 1e-12]
-            dfun = lte
-            sfun = gte
+    @app.callback(
+        Output('percolation-graph', 'figure'),
+        [Input('percolation-button', 'n_clicks'),
+        State('percolation-metric-select', 'value'),
+        State('percolation-bounds-select', 'value')],
+        background=True,
+        progress=[Output('percolation-progress', 'value'), Output('percolation-progress', 'max')],
+        running=[(Output('percolation-button', 'disabled'), True, False)],
+        cancel=[Input('percolation-metric-select', 'value')],
+        cache_args_to_ignore=[0],
+    )
+    @metrics.instrument('percolation')
+    def show_percolation(set_progress, click, metric, bound):
+        if not click:
+            raise dash.exceptions.PreventUpdate
+        with metrics.phase('filtering'):
+            curve = percolation_curve(store.data.G, metric, bound,
+                                      progress=lambda done, total: set_progress((done, total)))
+        with metrics.phase('layout'):
+            fig = make_percolation_figure(curve, metric)
+        return fig
 
-        if static_metric == 'p':
-            static_threshold = 0.05
-        else:
-            static_threshold = 50
-
-        records = []
-        node_list = []
-        for node in G.nodes:
-            node_list.append((node, {**G.nodes[node]}))
-
-        for dynamic_threshold in search:
-            F= nx.Graph()
-            F.add_nodes_from(node_list)
-
-            edges = []
-            for u,v,e in G.edges(data=True):
-                if dfun(e[dynamic_metric], dynamic_threshold) and sfun(e[static_metric], static_threshold):
-                #if e['lr'] >= lr_threshold and e['p'] <= p_threshold:
-                    edges.append((u,v, e))
-
-            F.add_edges_from(edges)
-
-            graph_degree = F.degree()
-            for i, node in enumerate(F.nodes):
-                Sub = F.subgraph(neighborhood(F, node, 2))
-                n_nodes = len(Sub.nodes)
-                n_edges = len(Sub.edges)
-
-                records.append({'node': node,
-                                'node_degree': graph_degree[node],
-                                'n_nodes': n_nodes,
-                                'n_edges': n_edges,
-                                dynamic_metric: dynamic_threshold,
-                                static_metric: static_threshold,})
-
-        rdf = pd.DataFrame.from_records(records)
-        plot = px.histogram(rdf, x='node', y=y, facet_col=dynamic_metric)
-        plot.update_layout({'height':800})
-        return plot
+    ################################################################################
+    ### Clustergram Callbacks                                                    ###
+    ################################################################################
+    @app.callback(
+        Output('clustergram-graph', 'figure'),
+        [Input('clustergram-colorscale', 'value')]
+    )
+    @metrics.instrument('clustergram')
+    def clustergram(scale):
+        data = store.data
+        with metrics.phase('layout'):
+            fig = make_clustergram_figure(data.tree, data.pa, scale)
+        return fig
 
 
     ################################################################################
@@ -690,19 +1008,24 @@ if __name__ == '__main__':
         [Output('page-content', 'children'),
         Output('page-1-nav', 'className'),
         Output('page-2-nav', 'className'),
-        Output('page-3-nav', 'className'),],
+        Output('page-3-nav', 'className'),
+        Output('page-4-nav', 'className'),],
         [Input('url', 'pathname'),]
     )
     def display_page(pathname):
         if pathname == '/page-1':
-            return page1_layout, 'active', '', '',
+            return make_page1_layout(store.data), 'active', '', '', '',
         elif pathname == '/page-2':
-            return page2_layout, '', 'active', '',
+            return make_page2_layout(store.data), '', 'active', '', '',
 
         elif pathname == '/page-3':
-            return page3_layout, '', '', 'active',
+            return make_page3_layout(store.data), '', '', 'active', '',
+
+        elif pathname == '/page-4':
+            return make_page4_layout(store.data), '', '', '', 'active',
 
         else:
-            return landing_page_layout, '', '', '',
+            return landing_page_layout, '', '', '', '',
 
-    app.run_server(debug=False)
\ No newline at end of file
+    store.start()
+    app.run(debug=False)
\ No newline at end of file
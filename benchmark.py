@@ -0,0 +1,230 @@
+import argparse
+import itertools as it
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import networkx as nx
+
+from utils import *
+from make_synthetic_data import generate
+from tree import read_newick
+
+argparser = argparse.ArgumentParser(description='Time and memory-profile the Indizio hot paths on synthetic data sets of increasing size.')
+argparser.add_argument('-o', help='Output file for the results (JSON).', default='benchmark_results.json')
+argparser.add_argument('--scales', help='Numbers of features to benchmark.', type=int, nargs='+', default=[100, 250, 500])
+argparser.add_argument('--samples', help='Number of samples in the presence/absence table.', type=int, default=100)
+argparser.add_argument('--density', help='Fraction of strongly associated feature pairs.', type=float, default=0.05)
+argparser.add_argument('--repeat', help='Number of timed runs per benchmark.', type=int, default=3)
+argparser.add_argument('--only', help='Only run the benchmarks with these names.', nargs='+')
+argparser.add_argument('--workdir', help='Directory for the generated data sets. Defaults to a temporary directory.')
+argparser.add_argument('--compare', help='Previous results file. Report the change of each benchmark relative to it.')
+argparser.add_argument('--tolerance', help='Slowdown ratio above which --compare reports a regression and exits with status 1.', type=float, default=1.25)
+argparser.add_argument('--min-seconds', help='Benchmarks faster than this are too noisy to be reported as regressions.', type=float, default=0.001)
+
+################################################################################
+### Benchmarks                                                               ###
+################################################################################
+# Each benchmark is set up once per scale from the shared context and returns
+# a zero-argument callable, which is what gets timed.
+
+def setup_initialize_data(ctx):
+    return lambda: initialize_data(ctx['sheet'])
+
+def setup_pearson_matrices(ctx):
+    if ctx['pa'] is None:
+        return None
+    return lambda: pearson_matrices(ctx['pa'])
+
+def setup_make_graph(ctx):
+    return lambda: make_graph(ctx['metas'], ctx['dms'])
+
+def setup_filter_graph(ctx):
+    return lambda: filter_graph(ctx['G'], ctx['focal'], 1, ctx['attributes'], ctx['thresholds'], ctx['bounds'])
+
+def setup_network_filter(ctx):
+    return lambda: NetworkFilter().update(ctx['edges'], ctx['focal'], 1, ctx['attributes'], ctx['thresholds'], ctx['bounds'])
+
+def setup_network_filter_update(ctx):
+    #Moves the first threshold back and forth by 10% on a filter that is kept between runs.
+    network = NetworkFilter()
+    network.update(ctx['edges'], ctx['focal'], 1, ctx['attributes'], ctx['thresholds'], ctx['bounds'])
+    moved = [ctx['thresholds'][0] * 1.1] + ctx['thresholds'][1:]
+    queries = it.cycle([moved, ctx['thresholds']])
+    return lambda: network.update(ctx['edges'], ctx['focal'], 1, ctx['attributes'], next(queries), ctx['bounds'])
+
+def setup_neighborhood(ctx):
+    H = ctx['H']
+    return lambda: [neighborhood(H, node, 2) for node in ctx['focal'] if node in H]
+
+def setup_nx_to_dash(ctx):
+    return lambda: nx_to_dash(ctx['H'], ctx['focal'], ctx['labels'])
+
+def setup_communities(ctx):
+    #Communities of the whole network at the default thresholds.
+    network = NetworkFilter()
+    network.update(ctx['edges'], range(len(ctx['labels'])), 1, ctx['attributes'], ctx['thresholds'], ctx['bounds'])
+    edges = ctx['edges']
+    return lambda: detect_communities(network.nodes, edges.src[network.edge_ids], edges.dst[network.edge_ids])
+
+def setup_centralities(ctx):
+    network = NetworkFilter()
+    network.update(ctx['edges'], range(len(ctx['labels'])), 1, ctx['attributes'], ctx['thresholds'], ctx['bounds'])
+    edges = ctx['edges']
+    return lambda: centralities(network.nodes, edges.src[network.edge_ids], edges.dst[network.edge_ids])
+
+def setup_threshold_statistics(ctx):
+    if 'lr' not in ctx['attributes'] or 'p' not in ctx['attributes']:
+        return None
+    return lambda: threshold_statistics(ctx['G'], 'lr', 'p')
+
+def setup_heatmap_figure(ctx):
+    label, frame = ctx['dms'][0]
+    meta = dict(ctx['metas']).get(label)
+    return lambda: make_heatmap_figure(frame, meta, 'inferno', np.nanmin(frame.values), np.nanmax(frame.values))
+
+def setup_cluster_order(ctx):
+    frame = ctx['dms'][0][1]
+    return lambda: cluster_order(frame)
+
+def setup_read_newick(ctx):
+    paths = pd.read_table(ctx['sheet'], sep=',')
+    paths = paths[paths['type'] == 'T']['filepath']
+    if len(paths) == 0:
+        return None
+    return lambda: read_newick(paths.iloc[0])
+
+def setup_clustergram_figure(ctx):
+    if ctx['tree'] is None or ctx['pa'] is None:
+        return None
+    return lambda: make_clustergram_figure(ctx['tree'], ctx['pa'], 'greys')
+
+def setup_percolation_curve(ctx):
+    return lambda: percolation_curve(ctx['G'], ctx['attributes'][0], ctx['bounds'][0])
+
+BENCHMARKS = [
+    ('initialize_data', setup_initialize_data),
+    ('pearson_matrices', setup_pearson_matrices),
+    ('make_graph', setup_make_graph),
+    ('filter_graph', setup_filter_graph),
+    ('network_filter', setup_network_filter),
+    ('network_filter_update', setup_network_filter_update),
+    ('neighborhood', setup_neighborhood),
+    ('nx_to_dash', setup_nx_to_dash),
+    ('communities', setup_communities),
+    ('centralities', setup_centralities),
+    ('threshold_statistics', setup_threshold_statistics),
+    ('percolation_curve', setup_percolation_curve),
+    ('heatmap_figure', setup_heatmap_figure),
+    ('cluster_order', setup_cluster_order),
+    ('read_newick', setup_read_newick),
+    ('clustergram_figure', setup_clustergram_figure),
+]
+
+def make_context(sheet):
+    #Loads a generated data set once; benchmarks reuse the loaded objects.
+    metas, dms, pa, tree, labels = initialize_data(sheet)
+    edges = make_edge_table(dms)
+    G = make_graph(metas, dms, edges)
+    attributes = [label for label, _ in dms]
+    # Default thresholds of make_synthetic_data keep only the strong pairs.
+    defaults = {'lr': (25, 1), 'p': (0.05, 2)}
+    thresholds = [defaults.get(attr, (0.75, 1))[0] for attr in attributes]
+    bounds = [defaults.get(attr, (0.75, 1))[1] for attr in attributes]
+    focal = list(G.nodes)[:5]
+    # The whole network at those thresholds, as shown when no node is selected.
+    keep = lambda e: all(e[a] >= t if b == 1 else e[a] <= t for a, t, b in zip(attributes, thresholds, bounds))
+    H = G.edge_subgraph([(u, v) for u, v, e in G.edges(data=True) if keep(e)])
+    return {
+        'sheet': sheet, 'metas': metas, 'dms': dms, 'pa': pa, 'tree': tree, 'G': G, 'H': H, 'edges': edges, 'labels': labels,
+        'attributes': attributes, 'thresholds': thresholds, 'bounds': bounds, 'focal': focal,
+    }
+
+def measure(func, repeat):
+    #Wall time of each run, and the peak allocation of one extra traced run.
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return times, peak
+
+def run(scales, repeat, workdir, n_samples, density, only=None):
+    results = []
+    for n in scales:
+        print("Generating data set with {} features. . .".format(n))
+        sheet = generate(os.path.join(workdir, 'features_{}'.format(n)), n_features=n,
+                         n_samples=n_samples, density=density)
+        ctx = make_context(sheet)
+        for name, setup in BENCHMARKS:
+            if only and name not in only:
+                continue
+            func = setup(ctx)
+            if func is None:
+                continue
+            times, peak = measure(func, repeat)
+            result = {
+                'benchmark': name,
+                'features': n,
+                'edges': ctx['G'].number_of_edges(),
+                'repeat': repeat,
+                'seconds_min': min(times),
+                'seconds_median': statistics.median(times),
+                'seconds_max': max(times),
+                'peak_bytes': peak,
+            }
+            print("{benchmark:>22} n={features:<7} median {seconds_median:.4f}s  peak {peak_bytes:>12,d} B".format(**result))
+            results.append(result)
+    return results
+
+def compare(results, previous, tolerance, min_seconds=0.001):
+    #Prints the median time ratio to a previous run. Returns the regressed benchmarks.
+    old = {(r['benchmark'], r['features']): r for r in previous['results']}
+    regressions = []
+    print("{:>22} {:>8} {:>12} {:>12} {:>8}".format('benchmark', 'features', 'old (s)', 'new (s)', 'ratio'))
+    for r in results:
+        key = (r['benchmark'], r['features'])
+        if key not in old:
+            continue
+        ratio = r['seconds_median'] / max(old[key]['seconds_median'], 1e-12)
+        flag = ''
+        if ratio > tolerance and r['seconds_median'] >= min_seconds:
+            flag = 'REGRESSION'
+            regressions.append(key)
+        print("{:>22} {:>8} {:>12.4f} {:>12.4f} {:>8.2f} {}".format(
+            key[0], key[1], old[key]['seconds_median'], r['seconds_median'], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    args = argparser.parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='indizio-bench-')
+    results = run(args.scales, args.repeat, workdir, args.samples, args.density, args.only)
+    output = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'networkx': nx.__version__,
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'arguments': vars(args),
+        'results': results,
+    }
+    with open(args.o, 'w') as fh:
+        json.dump(output, fh, indent=2)
+    print("Results written to {}".format(args.o))
+    if args.compare:
+        with open(args.compare) as fh:
+            previous = json.load(fh)
+        if compare(results, previous, args.tolerance, args.min_seconds):
+            sys.exit(1)
@@ -3,9 +3,10 @@ import dash
 from dash import dcc
 from dash import html
 import dash_bootstrap_components as dbc
+from xml.sax.saxutils import escape
 
 def make_navbar(active=0):
-    classnames = ['', '', '']
+    classnames = ['', '', '', '']
     classnames[active] = "active"
 
     navbar = dbc.NavbarSimple(
@@ -13,6 +14,7 @@ def make_navbar(active=0):
             dbc.NavItem(dbc.NavLink("Matrices", href="/page-1"),id='page-1-nav' ,className=classnames[0]),
             dbc.NavItem(dbc.NavLink("Network Visualization", href="page-2"),id='page-2-nav', className=classnames[1]),
             dbc.NavItem(dbc.NavLink("Network Statistics", href="page-3"),id='page-3-nav', className=classnames[2]),
+            dbc.NavItem(dbc.NavLink("Clustergram", href="page-4"),id='page-4-nav', className=classnames[3]),
         ],
         brand="Indizio",
         brand_href="/",
@@ -32,7 +34,30 @@ def make_network_form(attributes):
                 placeholder='Degree (depth of neighborhood)',
                 type='number', min=0, step=1, value=0
             ),
-        ])
+        ]),
+        # Alternatively, the neighborhood is every node within a distance in one attribute.
+        dbc.InputGroup([
+            dbc.InputGroupText("Neighborhood by"),
+            dbc.Select(
+                id='neighborhood-weight',
+                options=[{'label': 'Degree (hops)', 'value': ''}] +
+                        [{'label': 'Distance in {}'.format(attr), 'value': attr} for attr in attributes],
+                value='',
+            ),
+            dbc.Input(
+                id='radius',
+                placeholder='Radius (summed distance)',
+                type='number', min=0, value=None
+            ),
+        ]),
+        dbc.InputGroup([
+            dbc.InputGroupText("Show first the strongest edges by"),
+            dbc.Select(
+                id='stream-attribute',
+                options=[{'label': attr, 'value': attr} for attr in attributes],
+                value=next(iter(attributes), None),
+            ),
+        ]),
     ]
     for i, attr in enumerate(attributes):
         div = dbc.Row([
@@ -60,3 +85,20 @@ def make_network_form(attributes):
         ], className="border")
         data.append(div)
     return data
+
+def make_loading_page(message, refresh=True):
+    #Plain HTML page served while the data are loading. Deliberately not a Dash
+    #page, since the component libraries may not have been imported yet.
+    return """<!DOCTYPE html>
+<html>
+    <head>
+        <meta charset="UTF-8">
+        {refresh}
+        <title>Indizio</title>
+    </head>
+    <body style="font-family: sans-serif; text-align: center; margin-top: 20%;">
+        <h1>Indizio</h1>
+        <p style="white-space: pre-line;">{message}</p>
+    </body>
+</html>
+""".format(refresh='<meta http-equiv="refresh" content="2">' if refresh else '', message=escape(message))
@@ -0,0 +1,215 @@
+import threading
+import time
+import traceback
+
+from utils import initialize_data, make_edge_table, make_graph, data_fingerprint, LabelIndex
+from utils import file_stamps, reload_data, update_edge_table
+from utils import MAX_CLUSTER_FEATURES, cluster_order, frame_fingerprint
+from forksafe import fork_guard
+
+################################################################################
+### Data loading                                                             ###
+################################################################################
+
+class Dataset:
+    """
+    Everything loaded from one version of the sample sheet.
+
+    A Dataset is never modified once published; reloading builds a new one,
+    so callbacks can take a reference at their start and use it throughout.
+    The only exception is `orders`, which fills in as the clustering of each
+    distance matrix finishes in the background.
+    """
+    def __init__(self, metas, dms, pa, tree, G, edges, labels, key):
+        self.metas = metas
+        self.dms = dms
+        self.pa = pa
+        self.tree = tree
+        self.G = G
+        # The edges of G as arrays (an EdgeTable), for filtering the network.
+        self.edges = edges
+        # Nodes of G are ids; labels (a LabelTable) maps them to feature names.
+        self.labels = labels
+        # Identifies this version of the input files, e.g. in cache keys.
+        self.key = key
+        #dms is a list of tuples
+        self.dm_dict = {attr: frame for attr, frame in dms}
+        #metas is either list of tuples or empty list
+        self.meta_dict = {attr: frame for attr, frame in metas}
+        # Node dropdown options are searched on the server instead of shipped to the page.
+        self.label_index = LabelIndex(labels.names)
+        self.dm_metric_options = [{'label': attr, 'value': attr} for attr, _ in dms]
+        # Clustered row order of each distance matrix, by label.
+        self.orders = {}
+
+
+class DataStore:
+    """
+    Loads the data of a sample sheet in a background thread.
+
+    The web server can start, answer health checks and show a loading page
+    while the data are parsed. `data` is None until loading has finished.
+    Once it is ready, the distance matrices are clustered in the background;
+    the orders are kept in `cache` (a diskcache.Cache), so they are computed
+    only once per matrix content.
+
+    With `watch` (seconds), the input files are checked for changes at that
+    interval. Changed matrices and metadata are read again on their own and
+    only their edge attributes are rebuilt; a changed sample sheet or feature
+    set reloads everything. Meanwhile the old data are served, and the new
+    Dataset replaces them in one assignment. Its key differs, so cached
+    results of the old data are no longer used.
+    """
+    def __init__(self, path, cache=None, watch=None):
+        self.path = path
+        self.cache = cache
+        self.watch = watch
+        self.data = None
+        self.status = 'waiting'
+        self.step = ''
+        self.steps = []
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.reloads = 0
+        self.reload_error = None
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.status == 'ready'
+
+    @property
+    def failed(self):
+        return self.status == 'failed'
+
+    def start(self):
+        self.started = time.time()
+        self.status = 'loading'
+        self._thread = threading.Thread(target=self._load, name='indizio-loader', daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        #Blocks until loading finished or failed. Returns True if the data are ready.
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.ready
+
+    def _progress(self, step):
+        print("{}. . .".format(step))
+        if self.step:
+            self.steps.append((self.step, time.time()))
+        self.step = step
+
+    def _build(self, progress):
+        progress("Parsing sample sheet")
+        key = data_fingerprint(self.path)
+        metas, dms, pa, tree, labels = initialize_data(self.path)
+        progress("Initializing network")
+        edges = make_edge_table(dms)
+        G = make_graph(metas, dms, edges)
+        return Dataset(metas, dms, pa, tree, G, edges, labels, key)
+
+    def _load(self):
+        try:
+            stamps = file_stamps(self.path)
+            data = self._build(self._progress)
+            self._progress("Loading interface components")
+            # Heavy and only needed once the network page can be shown.
+            import dash_cytoscape as cyto
+            cyto.load_extra_layouts()
+            self.data = data
+            self._progress("Done")
+            self.finished = time.time()
+            self.status = 'ready'
+        except Exception as e:
+            traceback.print_exc()
+            self.error = '{0}: {1}'.format(type(e).__name__, e)
+            self.finished = time.time()
+            self.status = 'failed'
+            return
+        threading.Thread(target=self._cluster, args=(self.data,), name='indizio-clustering', daemon=True).start()
+        if self.watch:
+            threading.Thread(target=self._watch, args=(stamps,), name='indizio-watcher', daemon=True).start()
+
+    def _watch(self, stamps):
+        #Polls the input files. A change is acted on once the files stopped
+        #changing for one interval, so files still being written are not read.
+        pending = None
+        while True:
+            time.sleep(self.watch)
+            try:
+                current = file_stamps(self.path)
+            except Exception:
+                # e.g. a file is being replaced; look again next time
+                continue
+            if current == stamps:
+                pending = None
+            elif current != pending:
+                pending = current
+            else:
+                changed = {file for file in set(current) | set(stamps) if current.get(file) != stamps.get(file)}
+                stamps, pending = current, None
+                self._reload(changed)
+
+    def _reload(self, changed):
+        old = self.data
+        start = time.time()
+        print("Input files changed: {}".format(', '.join(sorted(changed))))
+        try:
+            key = data_fingerprint(self.path)
+            result = reload_data(self.path, old.metas, old.dms, old.pa, old.tree, old.labels, changed)
+            if result is None:
+                data = self._build(lambda step: print("{}. . .".format(step)))
+            else:
+                metas, dms, pa, tree, updated = result
+                edges = update_edge_table(old.edges, dms, updated)
+                G = make_graph(metas, dms, edges) if updated else old.G
+                data = Dataset(metas, dms, pa, tree, G, edges, old.labels, key)
+                # Orders of the unchanged matrices stay valid.
+                data.orders.update((attr, order) for attr, order in old.orders.items() if attr not in updated)
+        except Exception as e:
+            traceback.print_exc()
+            self.reload_error = '{0}: {1}'.format(type(e).__name__, e)
+            print("Reloading failed, keeping the previous data.")
+            return
+        self.data = data
+        self.reloads += 1
+        self.reload_error = None
+        print("Reloaded in {:.1f} s.".format(time.time() - start))
+        threading.Thread(target=self._cluster, args=(data,), name='indizio-clustering', daemon=True).start()
+
+    def _cluster(self, data):
+        for attr, frame in data.dms:
+            if frame.shape[0] > MAX_CLUSTER_FEATURES:
+                print("Not clustering {0}: more than {1} features.".format(attr, MAX_CLUSTER_FEATURES))
+                continue
+            try:
+                key = ('cluster-order', frame_fingerprint(frame))
+                order = None
+                if self.cache is not None:
+                    with fork_guard:
+                        order = self.cache.get(key)
+                if order is None:
+                    start = time.time()
+                    _, order = cluster_order(frame)
+                    print("Clustered {0} in {1:.1f} s.".format(attr, time.time() - start))
+                    if self.cache is not None:
+                        with fork_guard:
+                            self.cache.set(key, order)
+                data.orders[attr] = order
+            except Exception:
+                traceback.print_exc()
+
+    def report(self):
+        #Loading state, as served by the readiness endpoint.
+        end = self.finished or time.time()
+        return {
+            'status': self.status,
+            'step': self.step,
+            'completed_steps': [step for step, _ in self.steps],
+            'elapsed_seconds': round(end - self.started, 3) if self.started else 0,
+            'error': self.error,
+            'reloads': self.reloads,
+            'reload_error': self.reload_error,
+        }
@@ -0,0 +1,15 @@
+import os
+import threading
+
+################################################################################
+### Fork safety of the on-disk caches                                        ###
+################################################################################
+# Background callbacks are forked from a request thread of the server. A child
+# forked while another thread is inside an SQLite transaction inherits that
+# thread's locks on the database and waits for them forever. Every access to a
+# diskcache.Cache from a thread of the server therefore holds fork_guard, and
+# forking waits until no thread holds it.
+fork_guard = threading.Lock()
+os.register_at_fork(before=fork_guard.acquire,
+                    after_in_parent=fork_guard.release,
+                    after_in_child=fork_guard.release)
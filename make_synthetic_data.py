@@ -0,0 +1,111 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+argparser = argparse.ArgumentParser(description='Generate a synthetic Indizio data set (sample sheet, distance matrices, metadata and presence/absence table) for testing and benchmarking.')
+argparser.add_argument('-o', help='Output directory. Created if it does not exist.', required=True)
+argparser.add_argument('--features', help='Number of features (nodes).', type=int, default=500)
+argparser.add_argument('--samples', help='Number of samples (rows of the presence/absence table).', type=int, default=100)
+argparser.add_argument('--matrices', help='Number of distance matrices. The first two are named lr and p.', type=int, default=2)
+argparser.add_argument('--metadata-columns', help='Number of columns of each metadata file. 0 for no metadata.', type=int, default=3)
+argparser.add_argument('--density', help='Fraction of feature pairs that are strongly associated (i.e. pass the default thresholds).', type=float, default=0.05)
+argparser.add_argument('--pa-density', help='Mean fraction of samples in which a feature is present.', type=float, default=0.5)
+argparser.add_argument('--no-pa', help='Do not write a presence/absence table.', action='store_true')
+argparser.add_argument('--no-tree', help='Do not write a tree of the samples.', action='store_true')
+argparser.add_argument('--seed', help='Random seed.', type=int, default=0)
+
+################################################################################
+### Generators                                                               ###
+################################################################################
+def feature_names(n):
+    return ['feature_{}'.format(i) for i in range(n)]
+
+def strong_pairs(rng, n, density):
+    #Symmetric boolean mask of strongly associated feature pairs.
+    upper = np.triu(rng.random((n, n)) < density, 1)
+    return upper | upper.T
+
+def symmetric(values):
+    upper = np.triu(values)
+    return upper + np.triu(values, 1).T
+
+def make_matrix(rng, kind, strong):
+    #Distance matrix whose strong pairs pass the thresholds used for that kind of metric.
+    n = strong.shape[0]
+    if kind == 'lr':
+        # likelihood ratios: strong pairs >= 25
+        values = np.where(strong, rng.uniform(25, 200, (n, n)), rng.uniform(0, 25, (n, n)))
+    elif kind == 'p':
+        # p-values: strong pairs <= 0.05
+        values = np.where(strong, 10 ** rng.uniform(-12, np.log10(0.05), (n, n)), rng.uniform(0.05, 1, (n, n)))
+    else:
+        values = np.where(strong, rng.uniform(0.75, 1, (n, n)), rng.uniform(0, 0.75, (n, n)))
+    return symmetric(values)
+
+def make_metadata(rng, n, n_columns):
+    return rng.random((n, n_columns))
+
+def make_pa(rng, n_samples, n_features, pa_density):
+    #Binary samples x features table with a varying prevalence per feature.
+    prevalence = np.clip(rng.normal(pa_density, 0.15, n_features), 0.01, 0.99)
+    return (rng.random((n_samples, n_features)) < prevalence).astype(np.int8)
+
+def make_tree(rng, names):
+    #Random binary tree (Newick) over the given leaf names, with random branch lengths.
+    nodes = list(names)
+    while len(nodes) > 1:
+        i = rng.integers(len(nodes) - 1)
+        a, b = nodes[i], nodes.pop(i + 1)
+        nodes[i] = '({0}:{1:.4f},{2}:{3:.4f})'.format(a, rng.random(), b, rng.random())
+    return nodes[0] + ';'
+
+def generate(outdir, n_features=500, n_samples=100, n_matrices=2, n_metadata_columns=3,
+             density=0.05, pa_density=0.5, pa=True, tree=True, seed=0):
+    #Writes the data set into outdir and returns the path of its sample sheet.
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    features = feature_names(n_features)
+    strong = strong_pairs(rng, n_features, density)
+
+    records = []
+    if pa:
+        path = os.path.abspath(os.path.join(outdir, 'pa.csv'))
+        table = pd.DataFrame(make_pa(rng, n_samples, n_features, pa_density),
+                             index=['sample_{}'.format(i) for i in range(n_samples)],
+                             columns=features)
+        table.index.name = 'sample'
+        table.to_csv(path)
+        records.append({'filepath': path, 'type': 'P', 'label': 'P'})
+        if tree:
+            path = os.path.abspath(os.path.join(outdir, 'tree.nwk'))
+            with open(path, 'w') as fh:
+                fh.write(make_tree(rng, list(table.index)))
+            records.append({'filepath': path, 'type': 'T', 'label': 'T'})
+
+    labels = (['lr', 'p'] + ['dm{}'.format(i) for i in range(2, n_matrices)])[:n_matrices]
+    for label in labels:
+        path = os.path.abspath(os.path.join(outdir, '{}.csv'.format(label)))
+        pd.DataFrame(make_matrix(rng, label, strong), index=features, columns=features).to_csv(path)
+        records.append({'filepath': path, 'type': 'DM', 'label': label})
+
+    if n_metadata_columns > 0:
+        # Metadata are shown next to the distance matrix with the same label.
+        for label in labels:
+            path = os.path.abspath(os.path.join(outdir, '{}_metadata.csv'.format(label)))
+            pd.DataFrame(make_metadata(rng, n_features, n_metadata_columns), index=features,
+                         columns=['trait_{}'.format(i) for i in range(n_metadata_columns)]).to_csv(path)
+            records.append({'filepath': path, 'type': 'M', 'label': label})
+
+    sheet = os.path.join(outdir, 'samplesheet.csv')
+    pd.DataFrame.from_records(records, columns=['filepath', 'type', 'label']).to_csv(sheet, sep=',', index=False)
+    return sheet
+
+
+if __name__ == '__main__':
+    args = argparser.parse_args()
+    sheet = generate(args.o, n_features=args.features, n_samples=args.samples, n_matrices=args.matrices,
+                     n_metadata_columns=args.metadata_columns, density=args.density,
+                     pa_density=args.pa_density, pa=not args.no_pa, tree=not args.no_tree, seed=args.seed)
+    print("Sample sheet written to {}".format(sheet))
@@ -0,0 +1,211 @@
+import functools
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import flask
+import plotly.utils
+from dash.exceptions import PreventUpdate
+
+from forksafe import fork_guard
+
+################################################################################
+### Callback instrumentation                                                 ###
+################################################################################
+# Upper bounds (seconds) of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class CallbackMetrics:
+    """
+    Records wall time, peak allocation and serialized response size of Dash callbacks.
+
+    Measurements are kept in a diskcache.Cache rather than in memory because
+    background callbacks run in separate worker processes. Use a fresh cache
+    directory per server run so counters start from zero, as Prometheus expects.
+
+    :param cache: diskcache.Cache shared by the server and its job processes.
+    :param log: if True, print one JSON line per callback invocation.
+    :param trace_memory: if True, trace allocations with tracemalloc. Peaks are
+        process wide, so concurrent callbacks in the same process inflate each other.
+    """
+    def __init__(self, cache, log=False, trace_memory=True):
+        self.cache = cache
+        self.log = log
+        self.trace_memory = trace_memory
+        self._local = threading.local()
+
+    def instrument(self, name):
+        """Decorator recording every call of a callback under the given name."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if self.trace_memory and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                if self.trace_memory:
+                    tracemalloc.reset_peak()
+                    mem_start = tracemalloc.get_traced_memory()[0]
+                self._local.phases = {}
+                start = time.perf_counter()
+                try:
+                    result = func(*args, **kwargs)
+                except PreventUpdate:
+                    self._record(name, time.perf_counter() - start, None, 0, self._local.phases)
+                    self._local.phases = None
+                    raise
+                except Exception:
+                    self._record(name, time.perf_counter() - start, None, 0, self._local.phases, error=True)
+                    self._local.phases = None
+                    raise
+                with self.phase('serialization'):
+                    size = response_size(result)
+                peak = None
+                if self.trace_memory:
+                    peak = max(0, tracemalloc.get_traced_memory()[1] - mem_start)
+                self._record(name, time.perf_counter() - start, peak, size, self._local.phases)
+                self._local.phases = None
+                return result
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def phase(self, name):
+        """Times a phase (e.g. filtering, layout) of the callback currently running."""
+        phases = getattr(self._local, 'phases', None)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if phases is not None:
+                phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+    def _record(self, name, seconds, peak, size, phases, error=False):
+        key = ('callback', name)
+        with fork_guard, self.cache.transact():
+            rec = self.cache.get(key, None) or {
+                'count': 0,
+                'errors': 0,
+                'seconds': 0.0,
+                'buckets': [0] * len(BUCKETS),
+                'peak_bytes_last': 0,
+                'peak_bytes_max': 0,
+                'response_bytes': 0,
+                'response_bytes_max': 0,
+                'phases': {},
+            }
+            rec['count'] += 1
+            rec['errors'] += int(error)
+            rec['seconds'] += seconds
+            for i, le in enumerate(BUCKETS):
+                if seconds <= le:
+                    rec['buckets'][i] += 1
+            if peak is not None:
+                rec['peak_bytes_last'] = peak
+                rec['peak_bytes_max'] = max(rec['peak_bytes_max'], peak)
+            rec['response_bytes'] += size
+            rec['response_bytes_max'] = max(rec['response_bytes_max'], size)
+            for phase, t in phases.items():
+                total, count = rec['phases'].get(phase, (0.0, 0))
+                rec['phases'][phase] = (total + t, count + 1)
+            self.cache.set(key, rec)
+            names = self.cache.get('callbacks', [])
+            if name not in names:
+                self.cache.set('callbacks', names + [name])
+        if self.log:
+            print(json.dumps({
+                'event': 'callback',
+                'callback': name,
+                'seconds': round(seconds, 6),
+                'peak_bytes': peak,
+                'response_bytes': size,
+                'phases': {k: round(v, 6) for k, v in phases.items()},
+                'error': error,
+            }), flush=True)
+
+    def render(self):
+        """Returns all measurements in the Prometheus text exposition format."""
+        with fork_guard:
+            records = [(name, self.cache.get(('callback', name))) for name in self.cache.get('callbacks', [])]
+        lines = []
+        def family(metric, kind, help_text):
+            lines.append('# HELP {0} {1}'.format(metric, help_text))
+            lines.append('# TYPE {0} {1}'.format(metric, kind))
+
+        metric = 'indizio_callback_duration_seconds'
+        family(metric, 'histogram', 'Wall time spent in Dash callbacks.')
+        for name, rec in records:
+            for le, n in zip(BUCKETS, rec['buckets']):
+                lines.append('{0}_bucket{{callback="{1}",le="{2}"}} {3}'.format(metric, name, le, n))
+            lines.append('{0}_bucket{{callback="{1}",le="+Inf"}} {2}'.format(metric, name, rec['count']))
+            lines.append('{0}_sum{{callback="{1}"}} {2}'.format(metric, name, rec['seconds']))
+            lines.append('{0}_count{{callback="{1}"}} {2}'.format(metric, name, rec['count']))
+
+        metric = 'indizio_callback_errors_total'
+        family(metric, 'counter', 'Dash callbacks that raised an exception.')
+        for name, rec in records:
+            lines.append('{0}{{callback="{1}"}} {2}'.format(metric, name, rec['errors']))
+
+        metric = 'indizio_callback_phase_duration_seconds'
+        family(metric, 'summary', 'Wall time spent in each phase of a Dash callback.')
+        for name, rec in records:
+            for phase, (total, count) in sorted(rec['phases'].items()):
+                lines.append('{0}_sum{{callback="{1}",phase="{2}"}} {3}'.format(metric, name, phase, total))
+                lines.append('{0}_count{{callback="{1}",phase="{2}"}} {3}'.format(metric, name, phase, count))
+
+        metric = 'indizio_callback_peak_memory_bytes'
+        family(metric, 'gauge', 'Peak memory allocated during the last call of a Dash callback.')
+        for name, rec in records:
+            lines.append('{0}{{callback="{1}"}} {2}'.format(metric, name, rec['peak_bytes_last']))
+        metric = 'indizio_callback_peak_memory_bytes_max'
+        family(metric, 'gauge', 'Largest peak memory allocated by any call of a Dash callback.')
+        for name, rec in records:
+            lines.append('{0}{{callback="{1}"}} {2}'.format(metric, name, rec['peak_bytes_max']))
+
+        metric = 'indizio_callback_response_bytes'
+        family(metric, 'summary', 'Size of the JSON serialized callback response.')
+        for name, rec in records:
+            lines.append('{0}_sum{{callback="{1}"}} {2}'.format(metric, name, rec['response_bytes']))
+            lines.append('{0}_count{{callback="{1}"}} {2}'.format(metric, name, rec['count'] - rec['errors']))
+        metric = 'indizio_callback_response_bytes_max'
+        family(metric, 'gauge', 'Largest JSON serialized response of a Dash callback.')
+        for name, rec in records:
+            lines.append('{0}{{callback="{1}"}} {2}'.format(metric, name, rec['response_bytes_max']))
+        return '\n'.join(lines) + '\n'
+
+class CallbackRecorder:
+    """
+    Appends the request body of every Dash callback to a JSON lines file, for
+    replaying the traffic with replay.py.
+
+    Only the first request of a background callback is recorded, not the
+    requests polling for its result.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def register(self, server):
+        server.before_request(self.record)
+
+    def record(self):
+        request = flask.request
+        if request.path != '/_dash-update-component' or 'cacheKey' in request.args:
+            return None
+        body = request.get_json(silent=True)
+        if body is None:
+            return None
+        line = json.dumps({'time': time.time(), 'output': body.get('output'), 'body': body})
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+        return None
+
+def response_size(result):
+    #Size in bytes of the callback output once serialized the way Dash does it.
+    try:
+        return len(json.dumps(result, cls=plotly.utils.PlotlyJSONEncoder))
+    except TypeError:
+        # e.g. dash.no_update
+        return 0
@@ -0,0 +1,198 @@
+import argparse
+import json
+import re
+import sys
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+argparser = argparse.ArgumentParser(description='Replay callback requests recorded with app.py --record against a running Indizio server and report latencies.')
+argparser.add_argument('file', help='Recorded callback requests (JSON lines).')
+argparser.add_argument('--url', help='Base URL of the server.', default='http://localhost:8050')
+argparser.add_argument('--concurrency', help='Number of sessions replayed at the same time.', type=int, default=4)
+argparser.add_argument('--repeat', help='Replay every recorded session this many times, each as a separate session.', type=int, default=1)
+argparser.add_argument('--speed', help='Replay the recorded pauses between the requests of a session, sped up by this factor. 0 sends requests back to back.', type=float, default=0)
+argparser.add_argument('--poll-interval', help='Seconds between polls for the result of a background callback.', type=float, default=0.1)
+argparser.add_argument('--timeout', help='Seconds after which a request counts as failed.', type=float, default=300)
+argparser.add_argument('-o', help='Also write every request and the summary to this file (JSON).')
+
+SESSION = re.compile(r'"session": "([0-9a-f]+)"')
+
+################################################################################
+### Recorded sessions                                                        ###
+################################################################################
+
+def read_records(path):
+    with open(path) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+def group_sessions(records, repeat):
+    """
+    Splits the records into the request sequences of the browser sessions
+    that sent them, in recorded order. Requests without a session id are
+    independent and replayed on their own. Each repetition gets fresh
+    session ids, so the server treats it as another user.
+    """
+    sessions = defaultdict(list)
+    singles = []
+    for record in records:
+        found = SESSION.search(json.dumps(record['body']))
+        if found:
+            sessions[found.group(1)].append(record)
+        else:
+            singles.append([record])
+    groups = []
+    for r in range(repeat):
+        for session, sequence in sessions.items():
+            renamed = '{0}r{1}'.format(session, r)
+            groups.append([dict(record, body=json.loads(json.dumps(record['body']).replace(session, renamed)))
+                           for record in sequence])
+        groups.extend(singles)
+    return groups
+
+def component_key(component):
+    # Response keys are the component ids; pattern-matching ids are serialized.
+    if isinstance(component, dict):
+        return json.dumps(component, sort_keys=True, separators=(',', ':'))
+    return component
+
+def refresh(items, returned):
+    #Replaces recorded input/state values by the values the server returned earlier in this replay.
+    for item in items:
+        if isinstance(item, list):
+            refresh(item, returned)
+            continue
+        key = (component_key(item.get('id')), item.get('property'))
+        if key in returned:
+            item['value'] = returned[key]
+
+def remember(response, returned):
+    for component, props in (response or {}).items():
+        for prop, value in props.items():
+            # Patches are not the value the browser would hold afterwards.
+            if isinstance(value, dict) and '__dash_patch_update' in value:
+                continue
+            returned[(component, prop)] = value
+
+################################################################################
+### Requests                                                                 ###
+################################################################################
+
+def post(url, body, timeout):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as r:
+            return r.status, r.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+def send(base, body, poll_interval, timeout):
+    """
+    Sends one callback request, following background callbacks until their
+    result is ready, as the browser does. Returns (status, response, seconds);
+    status is the HTTP status code, or 'timeout' or 'error'.
+    """
+    url = base + '/_dash-update-component'
+    start = time.perf_counter()
+    background = False
+    try:
+        while True:
+            status, content = post(url, body, timeout)
+            if status == 204:
+                return status, None, time.perf_counter() - start
+            if status >= 400:
+                return status, None, time.perf_counter() - start
+            data = json.loads(content) if content else {}
+            if 'cacheKey' in data:
+                background = True
+                url = '{0}/_dash-update-component?cacheKey={1}&job={2}'.format(base, data['cacheKey'], data['job'])
+            # Polls of a running job answer {"multi": true}, maybe with its
+            # progress; only a body with "response" holds the result.
+            if 'response' in data or not background:
+                return status, data.get('response'), time.perf_counter() - start
+            if time.perf_counter() - start > timeout:
+                return 'timeout', None, time.perf_counter() - start
+            time.sleep(poll_interval)
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        return 'error', str(e), time.perf_counter() - start
+
+def replay_session(base, sequence, speed, poll_interval, timeout):
+    results = []
+    returned = {}
+    previous = None
+    for record in sequence:
+        if speed and previous is not None:
+            time.sleep(max(0, record['time'] - previous) / speed)
+        previous = record['time']
+        body = record['body']
+        refresh(body.get('inputs', []), returned)
+        refresh(body.get('state', []), returned)
+        status, response, seconds = send(base, body, poll_interval, timeout)
+        if status == 200:
+            remember(response, returned)
+        results.append({'output': record['output'], 'status': status, 'seconds': seconds,
+                        'error': response if status == 'error' else None})
+    return results
+
+################################################################################
+### Report                                                                   ###
+################################################################################
+
+def percentile(values, q):
+    #Nearest-rank percentile of a sorted list.
+    if not values:
+        return float('nan')
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+def summarize(results, wall):
+    failed = lambda r: r['status'] not in (200, 204)
+    by_output = defaultdict(list)
+    for r in results:
+        by_output[r['output']].append(r)
+    rows = []
+    for output, group in sorted(by_output.items(), key=lambda item: -len(item[1])) + [('all', results)]:
+        seconds = sorted(r['seconds'] for r in group if not failed(r))
+        rows.append({
+            'output': output,
+            'requests': len(group),
+            'errors': sum(map(failed, group)),
+            'error_rate': sum(map(failed, group)) / len(group) if group else 0,
+            'p50': percentile(seconds, 50),
+            'p95': percentile(seconds, 95),
+            'p99': percentile(seconds, 99),
+        })
+    return {'seconds': wall, 'requests': len(results),
+            'throughput': len(results) / wall if wall else float('nan'),
+            'callbacks': rows}
+
+def print_summary(summary):
+    print("{:>40} {:>8} {:>7} {:>9} {:>9} {:>9}".format('callback', 'requests', 'errors', 'p50 (s)', 'p95 (s)', 'p99 (s)'))
+    for row in summary['callbacks']:
+        name = row['output'] if len(row['output']) <= 40 else '...' + row['output'][-37:]
+        print("{:>40} {:>8} {:>7} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+            name, row['requests'], row['errors'], row['p50'], row['p95'], row['p99']))
+    print("{requests} requests in {seconds:.1f}s, {throughput:.2f} requests/s".format(**summary))
+
+
+if __name__ == '__main__':
+    args = argparser.parse_args()
+    groups = group_sessions(read_records(args.file), args.repeat)
+    if not groups:
+        sys.exit("No requests recorded in {}".format(args.file))
+    print("Replaying {} requests in {} sessions against {} . . .".format(
+        sum(map(len, groups)), len(groups), args.url))
+    base = args.url.rstrip('/')
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        done = pool.map(lambda sequence: replay_session(base, sequence, args.speed, args.poll_interval, args.timeout), groups)
+        results = [r for session in done for r in session]
+    summary = summarize(results, time.perf_counter() - start)
+    print_summary(summary)
+    if args.o:
+        with open(args.o, 'w') as fh:
+            json.dump({'arguments': vars(args), 'summary': summary, 'requests': results}, fh, indent=2)
+        print("Results written to {}".format(args.o))
@@ -0,0 +1,85 @@
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+import diskcache
+
+from forksafe import fork_guard
+
+################################################################################
+### Per session results                                                      ###
+################################################################################
+
+class SessionStore:
+    """
+    Results of each browser session (e.g. its filtered network or heatmap),
+    kept on the server.
+
+    Every page holds a session id in the graph-store. Callbacks save results
+    under that id and a name, and later callbacks look them up by the same
+    handle instead of recomputing them or sending them back and forth.
+
+    Background callbacks run in other processes, so the results are kept in a
+    diskcache.Cache rather than in memory. Its size is limited: beyond
+    `size_limit` bytes the least recently used results of all sessions are
+    evicted, so callbacks must be able to recompute anything they stored.
+
+    Results that several callbacks read, modify and write back are guarded by
+    lock(), which holds across processes.
+
+    :param directory: cache directory, preferably a fresh one per server run.
+    :param size_limit: budget in bytes for all sessions together.
+    :param expire: seconds after which the results of an idle session are dropped.
+    :param lock_expire: seconds after which a lock is released anyway, e.g.
+        when the job holding it was cancelled.
+    """
+    def __init__(self, directory, size_limit=2**30, expire=60*60*24, lock_expire=10):
+        self.cache = diskcache.Cache(directory, size_limit=size_limit,
+                                     eviction_policy='least-recently-used')
+        # Locks live apart from the results, where they are never evicted.
+        self.locks = diskcache.Cache(os.path.join(directory, 'locks'), eviction_policy='none')
+        self.expire = expire
+        self.lock_expire = lock_expire
+
+    @staticmethod
+    def handle(session, name):
+        return '{0}/{1}'.format(session, name)
+
+    def put(self, session, name, value):
+        #Saves a result and returns its handle.
+        handle = self.handle(session, name)
+        with fork_guard:
+            self.cache.set(handle, value, expire=self.expire)
+        return handle
+
+    def get(self, session, name, default=None):
+        if not session:
+            return default
+        with fork_guard:
+            return self.cache.get(self.handle(session, name), default)
+
+    @contextmanager
+    def lock(self, session, name):
+        #Holds off other threads and processes from the same result of the session,
+        #like diskcache.Lock, but without holding off forks while waiting.
+        key = self.handle(session, name)
+        # Once expired, the lock may be taken by another holder before this one
+        # finishes; the token keeps this one from releasing theirs.
+        token = uuid.uuid4().hex
+        while True:
+            with fork_guard:
+                if self.locks.add(key, token, expire=self.lock_expire, retry=True):
+                    break
+            time.sleep(0.001)
+        try:
+            yield
+        finally:
+            with fork_guard, self.locks.transact(retry=True):
+                if self.locks.get(key) == token:
+                    self.locks.delete(key)
+
+    def volume(self):
+        #Bytes used by all sessions.
+        with fork_guard:
+            return self.cache.volume()
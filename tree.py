@@ -0,0 +1,171 @@
+import re
+
+import numpy as np
+
+################################################################################
+### Newick trees                                                             ###
+################################################################################
+# Quoted labels, single punctuation characters or runs of anything else.
+_TOKEN = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),:;]|[^(),:;'\[]+")
+
+class NewickError(Exception):
+    pass
+
+
+class Tree:
+    """
+    Rooted tree stored as flat arrays, indexed by node number.
+
+    Nodes are numbered in pre-order (a parent always comes before its
+    children), and node 0 is the root.
+
+    :ivar parent: parent of each node, -1 for the root.
+    :ivar length: branch length to the parent (0 where the file gives none).
+    :ivar names: node labels ('' for unnamed nodes).
+    :ivar child_ptr, child_idx: children of node i are
+        child_idx[child_ptr[i]:child_ptr[i+1]], from left to right.
+    :ivar leaves: leaf nodes, from left to right.
+    """
+    def __init__(self, parent, length, names):
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.length = np.asarray(length, dtype=float)
+        self.names = names
+        n = len(self.parent)
+        counts = np.bincount(self.parent[1:], minlength=n)
+        self.child_ptr = np.concatenate([[0], np.cumsum(counts)])
+        # stable sort keeps siblings in file order
+        self.child_idx = np.argsort(self.parent[1:], kind='stable') + 1
+        self.leaves = np.flatnonzero(counts == 0)
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def leaf_names(self):
+        return [self.names[i] for i in self.leaves]
+
+    def children(self, node):
+        return self.child_idx[self.child_ptr[node]:self.child_ptr[node + 1]]
+
+    def depths(self):
+        #Distance of every node from the root. Unit lengths if the tree has no lengths.
+        length = self.length if self.length.any() else np.ones(len(self))
+        depth = np.zeros(len(self))
+        parent = self.parent
+        # pre-order numbering: parents are always done before their children
+        for i in range(1, len(self)):
+            depth[i] = depth[parent[i]] + length[i]
+        return depth
+
+    def leaf_positions(self):
+        #Vertical position of every node when leaves are drawn at 0, 1, 2, ...
+        #Internal nodes sit halfway between their first and last child.
+        y = np.zeros(len(self))
+        y[self.leaves] = np.arange(len(self.leaves))
+        first = np.full(len(self), np.inf)
+        last = np.full(len(self), -np.inf)
+        parent = self.parent
+        is_leaf = np.zeros(len(self), dtype=bool)
+        is_leaf[self.leaves] = True
+        # reverse pre-order: children are done before their parents
+        for i in range(len(self) - 1, 0, -1):
+            if not is_leaf[i]:
+                y[i] = (first[i] + last[i]) / 2
+            p = parent[i]
+            if y[i] < first[p]:
+                first[p] = y[i]
+            if y[i] > last[p]:
+                last[p] = y[i]
+        if len(self) > 1 and not is_leaf[0]:
+            y[0] = (first[0] + last[0]) / 2
+        return y
+
+
+def parse_newick(text):
+    #Parses a single Newick tree without recursion, so very deep or large trees are fine.
+    parent = []
+    length = []
+    names = []
+    stack = []
+    # the node that a following label or ':length' belongs to
+    last = None
+    expect_length = False
+
+    def new_node():
+        parent.append(stack[-1] if stack else -1)
+        length.append(0.0)
+        names.append('')
+        return len(parent) - 1
+
+    for match in _TOKEN.finditer(text):
+        token = match.group()
+        if token == '(':
+            if parent and not stack:
+                raise NewickError('More than one tree, or text before the tree.')
+            stack.append(new_node())
+            last = None
+        elif token == ',' or token == ')':
+            if not stack:
+                raise NewickError("Unbalanced parentheses at position {}.".format(match.start()))
+            if last is None:
+                # unnamed leaf, e.g. the first child in '(,A)'
+                new_node()
+            if token == ')':
+                last = stack.pop()
+            else:
+                last = None
+            expect_length = False
+        elif token == ':':
+            if last is None:
+                last = new_node()
+            expect_length = True
+        elif token == ';':
+            break
+        elif token[0] == '[':
+            # comment
+            continue
+        else:
+            token = token.strip()
+            if not token:
+                continue
+            if expect_length:
+                try:
+                    length[last] = float(token)
+                except ValueError:
+                    raise NewickError("Invalid branch length '{0}' at position {1}.".format(token, match.start()))
+                expect_length = False
+            else:
+                if last is None:
+                    last = new_node()
+                if token[0] == "'":
+                    token = token[1:-1].replace("''", "'")
+                names[last] = token
+    if stack:
+        raise NewickError('Unbalanced parentheses: {} unclosed.'.format(len(stack)))
+    if not parent:
+        raise NewickError('No tree found.')
+    return Tree(parent, length, names)
+
+
+def read_newick(path):
+    with open(path) as fh:
+        return parse_newick(fh.read())
+
+
+def dendrogram_lines(tree):
+    #Coordinates of a rectangular dendrogram (root on the left) as x, y arrays,
+    #with NaN between segments so it can be drawn as a single line trace.
+    depth = tree.depths()
+    y = tree.leaf_positions()
+    nodes = np.arange(1, len(tree))
+    par = tree.parent[nodes]
+    # horizontal branch of each node, from its parent's depth to its own
+    hx = np.column_stack([depth[par], depth[nodes], np.full(len(nodes), np.nan)])
+    hy = np.column_stack([y[nodes], y[nodes], np.full(len(nodes), np.nan)])
+    # vertical line of each internal node, spanning its first to last child
+    internal = np.flatnonzero(np.diff(tree.child_ptr) > 0)
+    first = tree.child_idx[tree.child_ptr[internal]]
+    last = tree.child_idx[tree.child_ptr[internal + 1] - 1]
+    vx = np.column_stack([depth[internal], depth[internal], np.full(len(internal), np.nan)])
+    vy = np.column_stack([y[first], y[last], np.full(len(internal), np.nan)])
+    return np.concatenate([hx.ravel(), vx.ravel()]), np.concatenate([hy.ravel(), vy.ravel()])
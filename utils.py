@@ -3,46 +3,71 @@ import pandas as pd
 from collections import Counter
 import networkx as nx
 import os
+import copy
+import csv
+import mmap
 import operator
-from tqdm import tqdm
-from _plotly_utils.basevalidators import ColorscaleValidator
+import hashlib
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left, bisect_right
 import plotly.colors
-from PIL import ImageColor
+from tree import read_newick, dendrogram_lines
+# PIL and plotly.graph_objects are imported in the functions using them,
+# they are slow to import and not needed to start the server.
 
 ################################################################################
 ### Network Utils                                                            ###
 ################################################################################
 
-def nx_to_dash(G, nodes):
+def nx_to_dash(G, nodes, labels):
+    #Cytoscape elements of G. Node ids are turned into their labels (a LabelTable)
+    #here, since the browser identifies nodes by label.
+    nodes = set(nodes)
+    names = labels.names
     nodesout = []
     for n in G.nodes:
         if n in nodes:
             nodesout.append({
-                        'data': {'id':n, 'label':n, **G.nodes[n]},
+                        'data': {'id':names[n], 'label':names[n], **G.nodes[n]},
                         'classes': 'focal',
             })
         else:
-            nodesout.append({'data': {'id':n, 'label':n, **G.nodes[n]},
+            nodesout.append({'data': {'id':names[n], 'label':names[n], **G.nodes[n]},
                         'classes':'other',
             })
     edges = []
     for e in G.edges:
-        edges.append({'data': {'source': e[0], 'target': e[1], **G.edges[e]}})
+        edges.append({'data': {'source': names[e[0]], 'target': names[e[1]], **G.edges[e]}})
     return nodesout + edges
 
-def neighborhood(G, node, n):
-    path_lengths = nx.single_source_dijkstra_path_length(G, node)
-    return [node for node, length in path_lengths.items()
-                    if length <= n]
+def quantize(threshold):
+    #Rounds a threshold the way matrix values were rounded when read, so a
+    #threshold equal to a value in the file keeps that value.
+    return float(MATRIX_DTYPE(threshold))
 
-def filter_graph(G, nodes, d, attributes, thresholds, bounds):
+def neighborhood(G, node, n, weight=None):
+    #Nodes within n hops of node, or within distance n summed over the edge
+    #attribute `weight`. The search stops at n instead of visiting the whole graph.
+    if weight is None:
+        return list(nx.single_source_shortest_path_length(G, node, cutoff=n))
+    return list(nx.single_source_dijkstra_path_length(G, node, cutoff=n, weight=weight))
+
+def filter_graph(G, nodes, d, attributes, thresholds, bounds, progress=None):
     print("FILTER GRAPH")
     print(attributes, thresholds, bounds)
+    thresholds = [quantize(thresh) for thresh in thresholds]
     op_dict = {1: operator.ge, #Threshold is a lower bound, so edges must be >= thresh
            2: operator.le, #Threshold is an upper bound, so edges must be <= thresh
            }
     subgraphs = []
-    for node in nodes:
+    #progress is an optional callable(done, total), used by background jobs.
+    #Report roughly every 1% so large node lists don't flood the job cache.
+    step = max(1, len(nodes) // 100)
+    for i, node in enumerate(nodes):
+        if progress and i % step == 0:
+            progress(i, len(nodes))
         print("fg ", node)
         node_list = []
         if d == 0:
@@ -68,6 +93,708 @@ def filter_graph(G, nodes, d, attributes, thresholds, bounds):
             subgraphs.append(G.subgraph([node]))
     return nx.compose_all(subgraphs)
 
+def threshold_statistics(G, dynamic_metric, static_metric, progress=None):
+    #Per node degree and 2-neighborhood size of G, at several thresholds of the
+    #dynamic metric while the static metric is held at a fixed threshold.
+    lte = lambda x,y: x<=y
+    gte = lambda x,y: x>=y
+
+    if dynamic_metric == 'lr':
+        search = [25, 50, 100, 150]
+        dfun = gte
+        sfun = lte
+
+    else:
+        search = [0.05, 1e-5, 1e-9, 1e-12]
+        dfun = lte
+        sfun = gte
+
+    if static_metric == 'p':
+        static_threshold = 0.05
+    else:
+        static_threshold = 50
+
+    records = []
+    node_list = []
+    for node in G.nodes:
+        node_list.append((node, {**G.nodes[node]}))
+
+    for step, dynamic_threshold in enumerate(search):
+        if progress:
+            progress(step, len(search))
+        F= nx.Graph()
+        F.add_nodes_from(node_list)
+
+        edges = []
+        # compared the way matrix values were rounded when read
+        dynamic_cut, static_cut = quantize(dynamic_threshold), quantize(static_threshold)
+        for u,v,e in G.edges(data=True):
+            if dfun(e[dynamic_metric], dynamic_cut) and sfun(e[static_metric], static_cut):
+            #if e['lr'] >= lr_threshold and e['p'] <= p_threshold:
+                edges.append((u,v, e))
+
+        F.add_edges_from(edges)
+
+        graph_degree = F.degree()
+        for i, node in enumerate(F.nodes):
+            Sub = F.subgraph(neighborhood(F, node, 2))
+            n_nodes = len(Sub.nodes)
+            n_edges = len(Sub.edges)
+
+            records.append({'node': node,
+                            'node_degree': graph_degree[node],
+                            'n_nodes': n_nodes,
+                            'n_edges': n_edges,
+                            dynamic_metric: dynamic_threshold,
+                            static_metric: static_threshold,})
+
+    if progress:
+        progress(len(search), len(search))
+    return pd.DataFrame.from_records(records)
+
+def percolation_curve(G, attribute, bound=1, progress=None):
+    #Connectivity of G at every distinct threshold of an edge attribute.
+    #Edges are sorted once and added strongest first (largest values for a
+    #lower bound, smallest for an upper bound) to a union-find, so the whole
+    #curve costs about as much as the sort.
+    index = {node: i for i, node in enumerate(G.nodes)}
+    n = len(index)
+    src, dst, weights = [], [], []
+    for u, v, value in G.edges(data=attribute):
+        if value is None or value != value:
+            continue
+        src.append(index[u])
+        dst.append(index[v])
+        weights.append(value)
+    weights = np.asarray(weights, dtype=float)
+    order = np.argsort(-weights if bound == 1 else weights, kind='stable')
+    weights = weights[order]
+    src = np.asarray(src, dtype=np.int64)[order].tolist()
+    dst = np.asarray(dst, dtype=np.int64)[order].tolist()
+    # last edge of each run of equal values
+    ends = np.flatnonzero(weights[1:] != weights[:-1]).tolist() + [len(weights) - 1]
+
+    parent = list(range(n))
+    size = [1] * n
+    components = n
+    largest = 1 if n else 0
+    thresholds, n_components, largest_sizes, n_edges = [], [], [], []
+    step = max(1, len(weights) // 100)
+    e = 0
+    for end in ends if len(weights) else []:
+        while e <= end:
+            if progress and e % step == 0:
+                progress(e, len(weights))
+            a = src[e]
+            while parent[a] != a:
+                parent[a] = parent[parent[a]]
+                a = parent[a]
+            b = dst[e]
+            while parent[b] != b:
+                parent[b] = parent[parent[b]]
+                b = parent[b]
+            if a != b:
+                if size[a] < size[b]:
+                    a, b = b, a
+                parent[b] = a
+                size[a] += size[b]
+                components -= 1
+                if size[a] > largest:
+                    largest = size[a]
+            e += 1
+        thresholds.append(weights[end])
+        n_components.append(components)
+        largest_sizes.append(largest)
+        n_edges.append(end + 1)
+    if progress:
+        progress(len(weights), len(weights))
+    return pd.DataFrame({
+        'threshold': thresholds,
+        'n_components': n_components,
+        'largest_component': largest_sizes,
+        'n_edges': n_edges,
+    })
+
+
+def gather(ptr, values, rows):
+    #Concatenation of values[ptr[r]:ptr[r+1]] for all rows r, without a Python loop.
+    starts = ptr[rows]
+    lengths = ptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return values[offsets + np.arange(len(offsets))]
+
+def incidence(src, dst, ids, n_nodes):
+    #(ptr, incident) such that the edges of node i among ids are incident[ptr[i]:ptr[i+1]].
+    #Every edge is listed under both ends, self loops once.
+    src, dst = src[ids], dst[ids]
+    loop = src == dst
+    ends = np.concatenate([src, dst[~loop]])
+    listed = np.concatenate([ids, ids[~loop]])
+    ptr = np.concatenate([[0], np.cumsum(np.bincount(ends, minlength=n_nodes))])
+    return ptr, listed[np.argsort(ends, kind='stable')]
+
+class EdgeTable:
+    """
+    Edges of the full graph as flat arrays, for vectorized filtering.
+
+    Edge k joins the nodes src[k] <= dst[k] and has the value values[attr][k]
+    of every distance matrix. order[attr] lists the edges by increasing value
+    (NaN last) and ranked[attr] holds those values, so the edges between two
+    values are a slice of order[attr]. The edges of node i are
+    incident[ptr[i]:ptr[i+1]].
+    """
+    def __init__(self, src, dst, values, n_nodes):
+        self.src = np.asarray(src, dtype=np.int32)
+        self.dst = np.asarray(dst, dtype=np.int32)
+        self.values = values
+        self.n_nodes = n_nodes
+        self.order = {}
+        self.ranked = {}
+        for attr, v in values.items():
+            order = np.argsort(v, kind='stable').astype(np.int32)
+            self.order[attr] = order
+            self.ranked[attr] = v[order]
+        self.ptr, self.incident = incidence(self.src, self.dst, np.arange(len(self.src), dtype=np.int32), n_nodes)
+
+    def __len__(self):
+        return len(self.src)
+
+    @property
+    def attributes(self):
+        return list(self.values)
+
+    def fails(self, attribute, threshold, bound, ids=None):
+        #True for every edge (or only those in ids) failing the threshold (a lower bound if bound is 1, else an upper bound).
+        v = self.values[attribute] if ids is None else self.values[attribute][ids]
+        return ~(v >= threshold if bound == 1 else v <= threshold)
+
+    def between(self, attribute, old, new, bound):
+        #Edges whose pass/fail state for the attribute changes when its threshold moves from old to new.
+        ranked = self.ranked[attribute]
+        # values equal to a threshold pass, so they belong to the side of the other one
+        side = 'left' if bound == 1 else 'right'
+        lo, hi = sorted((np.searchsorted(ranked, old, side), np.searchsorted(ranked, new, side)))
+        return self.order[attribute][lo:hi]
+
+    def replace(self, attribute, values):
+        #Copy with new values of one attribute. Only its order is recomputed, all other arrays are shared.
+        table = copy.copy(self)
+        table.values = dict(self.values, **{attribute: values})
+        order = np.argsort(values, kind='stable').astype(np.int32)
+        table.order = dict(self.order, **{attribute: order})
+        table.ranked = dict(self.ranked, **{attribute: values[order]})
+        return table
+
+def make_edge_table(distance_files):
+    #One edge per pair of features (including each feature with itself) that has
+    #a value in the first matrix. The matrices must be aligned to the same label order.
+    edge_dfs = [tup[1] for tup in distance_files]
+    # Make sure the dfs are all same shapes
+    assert len(set(df.shape for df in edge_dfs)) == 1
+    n = edge_dfs[0].shape[0]
+    rows, cols = np.triu_indices(n)
+    values = [df.to_numpy()[rows, cols] for df in edge_dfs]
+    keep = ~np.isnan(values[0])
+    return EdgeTable(rows[keep], cols[keep], {attr: v[keep] for (attr, _), v in zip(distance_files, values)}, n)
+
+def update_edge_table(edges, distance_files, changed):
+    #EdgeTable after the matrices named in `changed` were modified. Only their
+    #columns are rebuilt, unless the missing values of the first matrix moved,
+    #which changes the edges themselves.
+    frames = dict(distance_files)
+    first = distance_files[0][0]
+    if first in changed:
+        values = frames[first].to_numpy()
+        if np.isnan(values[edges.src, edges.dst]).any() or \
+                np.count_nonzero(~np.isnan(values[np.triu_indices(len(values))])) != len(edges):
+            return make_edge_table(distance_files)
+    for attr in changed:
+        edges = edges.replace(attr, frames[attr].to_numpy()[edges.src, edges.dst])
+    return edges
+
+class NetworkFilter:
+    """
+    The part of the network shown for a query.
+
+    That is the focal nodes, all nodes within `degree` hops of them over edges
+    passing every threshold, and the passing edges among those nodes. With a
+    degree of 0 only the passing edges of the focal nodes are kept. Given a
+    `weight` attribute, the neighborhood is instead all nodes within a summed
+    distance of `radius` in that attribute; edges with negative or missing
+    values are not followed.
+
+    Thresholds are only evaluated for the edges of the nodes reached, so the
+    cost of a query grows with the neighborhood rather than with the whole
+    table. When a later query only moves thresholds or the degree, it starts
+    from the current result: a stricter threshold filters the edges shown, a
+    looser one adds the edges between its old and new value, and only nodes
+    that were not expanded before have their edges gathered from the table.
+    The filter keeps just the query and its result, no per-edge state, and
+    holds no reference to the EdgeTable, so it is small to pickle and keep per
+    session; update() must be given the same EdgeTable every time.
+    """
+    def __init__(self):
+        self.attributes = None
+        self.thresholds = None
+        self.bounds = None
+        self.degree = None
+        self.weight = None
+        self.radius = None
+        self.focal = np.empty(0, dtype=np.int64)
+        self.nodes = np.empty(0, dtype=np.int64)
+        self.edge_ids = np.empty(0, dtype=np.int64)
+
+    def update(self, edges, focal, degree, attributes, thresholds, bounds, weight=None, radius=None):
+        #Applies a query. Returns the number of edges whose thresholds were evaluated.
+        thresholds = [quantize(t) for t in thresholds]
+        bounds = [int(b) for b in bounds]
+        focal = np.unique(np.asarray(focal, dtype=np.int64))
+        self._visited = 0
+        if (weight is None and self.weight is None and self.thresholds is not None and
+                list(attributes) == self.attributes and bounds == self.bounds and
+                np.array_equal(focal, self.focal)):
+            for i, thresh in enumerate(thresholds):
+                if thresh != self.thresholds[i]:
+                    self._move_threshold(edges, i, thresh)
+            if degree != self.degree:
+                self._refine(edges, self.edge_ids, degree)
+            return self._visited
+        self.attributes = list(attributes)
+        self.thresholds = thresholds
+        self.bounds = bounds
+        self.focal = focal
+        self.degree = degree
+        self.weight = weight
+        self.radius = quantize(radius or 0) if weight is not None else None
+        if weight is None:
+            self.nodes, self.edge_ids = self._neighborhood(edges, self.focal, degree)
+        else:
+            self.nodes, self.edge_ids = self._weighted_neighborhood(edges, self.focal, weight, self.radius)
+        return self._visited
+
+    def same_query(self, focal, degree, attributes, thresholds, bounds, weight=None, radius=None):
+        #True if update() with these arguments would give the current result.
+        radius = quantize(radius or 0) if weight is not None else None
+        return (self.thresholds is not None and degree == self.degree and
+                weight == self.weight and radius == self.radius and
+                list(attributes) == self.attributes and
+                [quantize(t) for t in thresholds] == self.thresholds and
+                [int(b) for b in bounds] == self.bounds and
+                np.array_equal(np.unique(np.asarray(focal, dtype=np.int64)), self.focal))
+
+    def _passing_ids(self, edges, ids):
+        #The edges among ids passing every threshold; missing values fail.
+        self._visited += len(ids)
+        for attr, thresh, bound in zip(self.attributes, self.thresholds, self.bounds):
+            ids = ids[~edges.fails(attr, thresh, bound, ids)]
+        return ids
+
+    def _passing(self, edges, nodes):
+        return self._passing_ids(edges, gather(edges.ptr, edges.incident, nodes))
+
+    def _move_threshold(self, edges, i, thresh):
+        #Moves threshold i of the current query to thresh.
+        attr, old, bound = self.attributes[i], self.thresholds[i], self.bounds[i]
+        self.thresholds = self.thresholds[:i] + [thresh] + self.thresholds[i + 1:]
+        if (thresh > old) == (bound == 1):
+            # stricter: only edges shown before can still pass
+            self._visited += len(self.edge_ids)
+            known = self.edge_ids[~edges.fails(attr, thresh, bound, self.edge_ids)]
+        else:
+            # looser: the edges in between pass too, if they pass the other thresholds
+            known = np.union1d(self.edge_ids, self._passing_ids(edges, edges.between(attr, old, thresh, bound)))
+        self._refine(edges, known, self.degree)
+
+    def _refine(self, edges, known, degree):
+        #Recomputes the result for `degree` from the current one, given all
+        #passing edges among the nodes shown (known).
+        expanded = np.zeros(edges.n_nodes, dtype=bool)
+        expanded[self.focal] = True
+        if self.degree > 1:
+            # The nodes within degree - 1 hops had all their edges followed, so they are shown.
+            ptr, incident = incidence(edges.src, edges.dst, self.edge_ids, edges.n_nodes)
+            frontier = self.focal
+            for _ in range(self.degree - 1):
+                ids = gather(ptr, incident, frontier)
+                ends = np.concatenate([edges.src[ids], edges.dst[ids]])
+                frontier = np.unique(ends[~expanded[ends]])
+                if len(frontier) == 0:
+                    break
+                expanded[frontier] = True
+        # every passing edge among the nodes shown is, except with degree 0 where only those of the focal nodes are
+        covered = np.zeros(edges.n_nodes, dtype=bool)
+        covered[self.nodes if self.degree > 0 else self.focal] = True
+        self.nodes, self.edge_ids = self._neighborhood(edges, self.focal, degree, known, expanded, covered)
+        self.degree = degree
+
+    def _neighborhood(self, edges, focal, degree, known=None, expanded=None, covered=None):
+        #Given an earlier result, `known` holds passing edges including all
+        #those of the `expanded` nodes and all those among the `covered` nodes
+        #(masks over all nodes); only the edges of other nodes are gathered.
+        if known is None:
+            known = np.empty(0, dtype=np.int64)
+            expanded = covered = np.zeros(edges.n_nodes, dtype=bool)
+        ptr, incident = incidence(edges.src, edges.dst, known, edges.n_nodes)
+        def passing(nodes):
+            inside = expanded[nodes]
+            return np.concatenate([gather(ptr, incident, nodes[inside]), self._passing(edges, nodes[~inside])])
+        if degree == 0:
+            edge_ids = np.unique(passing(focal))
+            nodes = np.union1d(focal, np.concatenate([edges.src[edge_ids], edges.dst[edge_ids]]))
+            return nodes, edge_ids
+        seen = np.zeros(edges.n_nodes, dtype=bool)
+        seen[focal] = True
+        frontier = focal
+        for _ in range(degree):
+            ids = passing(frontier)
+            ends = np.concatenate([edges.src[ids], edges.dst[ids]])
+            frontier = np.unique(ends[~seen[ends]])
+            if len(frontier) == 0:
+                break
+            seen[frontier] = True
+        nodes = np.flatnonzero(seen)
+        ids = np.unique(np.concatenate([known, self._passing(edges, nodes[~covered[nodes]])]))
+        return nodes, ids[seen[edges.src[ids]] & seen[edges.dst[ids]]]
+
+    def _weighted_neighborhood(self, edges, focal, weight, radius):
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import dijkstra
+        # No path within the radius takes an edge longer than the radius, so
+        # the adjacency only needs the shortest edges, a prefix of the order.
+        ids = edges.order[weight][:np.searchsorted(edges.ranked[weight], radius, 'right')]
+        values = edges.values[weight][ids]
+        ids = ids[(values >= 0) & (edges.src[ids] != edges.dst[ids])]
+        ids = self._passing_ids(edges, ids)
+        n = edges.n_nodes
+        adjacency = csr_matrix((edges.values[weight][ids], (edges.src[ids], edges.dst[ids])), shape=(n, n))
+        seen = np.zeros(n, dtype=bool)
+        if len(focal):
+            # one search from all focal nodes at once, abandoned beyond the radius
+            distance = dijkstra(adjacency, directed=False, indices=focal, limit=radius, min_only=True)
+            seen[np.isfinite(distance)] = True
+        nodes = np.flatnonzero(seen)
+        ids = np.unique(self._passing(edges, nodes))
+        return nodes, ids[seen[edges.src[ids]] & seen[edges.dst[ids]]]
+
+    def to_networkx(self, edges):
+        H = nx.Graph()
+        H.add_nodes_from(self.nodes.tolist())
+        attrs = edges.attributes
+        values = [edges.values[attr][self.edge_ids].tolist() for attr in attrs]
+        H.add_edges_from(zip(edges.src[self.edge_ids].tolist(), edges.dst[self.edge_ids].tolist(),
+                             (dict(zip(attrs, vals)) for vals in zip(*values))))
+        return H
+
+    def fingerprint(self):
+        #Identifies the nodes and edges shown, e.g. to cache results computed from them.
+        digest = hashlib.md5()
+        digest.update(self.nodes.tobytes())
+        digest.update(self.edge_ids.tobytes())
+        return digest.hexdigest()
+
+    def element_keys(self, communities=None):
+        #Identifies every element shown, in the order they are sent to Cytoscape.
+        #communities optionally gives the community of every node, see detect_communities.
+        focal = set(self.focal.tolist())
+        if communities is None:
+            communities = [None] * len(self.nodes)
+        else:
+            communities = communities.tolist()
+        return [('node', n, n in focal, c) for n, c in zip(self.nodes.tolist(), communities)] + \
+               [('edge', k) for k in self.edge_ids.tolist()]
+
+def make_elements(keys, edges, labels):
+    #Cytoscape elements for element keys of a NetworkFilter.
+    names = labels.names
+    attrs = edges.attributes
+    elements = []
+    for key in keys:
+        if key[0] == 'node':
+            data = {'id': names[key[1]], 'label': names[key[1]]}
+            if key[3] is not None:
+                data['community'] = key[3]
+            elements.append({'data': data, 'classes': 'focal' if key[2] else 'other'})
+        else:
+            k = key[1]
+            elements.append({'data': {'source': names[edges.src[k]], 'target': names[edges.dst[k]],
+                                      **{attr: float(edges.values[attr][k]) for attr in attrs}}})
+    return elements
+
+def stream_order(keys, edges, attribute, bound):
+    #Orders element keys for progressive display: focal nodes first, then the
+    #edges from the strongest (highest value of the attribute for a lower bound,
+    #lowest for an upper bound), each preceded by its nodes not listed yet, then
+    #the remaining nodes. Every prefix is a valid list of Cytoscape elements.
+    nodes = {key[1]: key for key in keys if key[0] == 'node'}
+    edge_ids = np.array([key[1] for key in keys if key[0] == 'edge'], dtype=np.int64)
+    strength = edges.values[attribute][edge_ids]
+    # missing values last
+    order = np.argsort(-strength if bound == 1 else strength, kind='stable')
+    order = np.concatenate([order[~np.isnan(strength[order])], order[np.isnan(strength[order])]])
+    ordered = [key for key in nodes.values() if key[2]]
+    listed = {key[1] for key in ordered}
+    for k, u, v in zip(edge_ids[order].tolist(), edges.src[edge_ids[order]].tolist(), edges.dst[edge_ids[order]].tolist()):
+        for node in (u, v):
+            if node not in listed:
+                listed.add(node)
+                ordered.append(nodes[node])
+        ordered.append(('edge', k))
+    ordered += [key for node, key in nodes.items() if node not in listed]
+    return ordered
+
+def diff_elements(old_keys, new_keys):
+    #Positions (in old_keys) of the elements to remove and the keys to append,
+    #so that the old element list turns into one holding the new keys.
+    new_set, old_set = set(new_keys), set(old_keys)
+    removed = [i for i, key in enumerate(old_keys) if key not in new_set]
+    added = [key for key in new_keys if key not in old_set]
+    return removed, added
+
+
+################################################################################
+### Community Utils                                                          ###
+################################################################################
+# Louvain gives the better partition, but in pure Python; above this many
+# edges the vectorized label propagation is used.
+LOUVAIN_MAX_EDGES = 20000
+
+def detect_communities(nodes, src, dst, seed=0):
+    #Community of each of the sorted node ids `nodes`, given the edges src[k]-dst[k]
+    #among them. Communities are numbered by decreasing size, so 0 is the largest.
+    n = len(nodes)
+    src, dst = np.searchsorted(nodes, src), np.searchsorted(nodes, dst)
+    loop = src == dst
+    src, dst = src[~loop], dst[~loop]
+    if len(src) <= LOUVAIN_MAX_EDGES:
+        H = nx.Graph()
+        H.add_nodes_from(range(n))
+        H.add_edges_from(zip(src.tolist(), dst.tolist()))
+        labels = np.empty(n, dtype=np.int64)
+        for i, community in enumerate(nx.community.louvain_communities(H, seed=seed)):
+            labels[list(community)] = i
+    else:
+        labels = label_propagation(n, src, dst, seed=seed)
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    rank = np.empty(len(counts), dtype=np.int64)
+    rank[np.argsort(-counts, kind='stable')] = np.arange(len(counts))
+    return rank[inverse]
+
+def label_propagation(n, src, dst, seed=0, max_iter=20, tolerance=5e-3):
+    #Every node repeatedly takes the label most common among its neighbors,
+    #keeping its own if it is among the most common. The votes of all nodes are
+    #counted at once with one sort per round; only a random half of the nodes
+    #moves per round, which stops labels from oscillating between two neighbors.
+    rng = np.random.default_rng(seed)
+    own = np.arange(n)
+    voter = np.concatenate([src, dst, own]).astype(np.int64)
+    # each node also votes for its own label, with weight 0, so isolated nodes keep theirs
+    weight = np.concatenate([np.ones(2 * len(src)), np.zeros(n)])
+    labels = own.copy()
+    for _ in range(max_iter):
+        votes, inverse = np.unique(voter * n + labels[np.concatenate([dst, src, own])], return_inverse=True)
+        node, label = votes // n, votes % n
+        # Counts are whole numbers, so the fractions only break ties: the
+        # current label first, then a random one.
+        score = np.bincount(inverse, weights=weight) + 0.5 * (label == labels[node]) + 0.25 * rng.random(len(votes))
+        # votes are sorted by node and every node has at least its own
+        starts = np.flatnonzero(np.concatenate([[True], node[1:] != node[:-1]]))
+        top = np.maximum.reduceat(score, starts)
+        winners = np.flatnonzero(score == top[node])
+        best = label[winners[np.concatenate([[True], node[winners][1:] != node[winners][:-1]])]]
+        move = rng.random(n) < 0.5
+        changed = np.count_nonzero(move & (best != labels))
+        labels = np.where(move, best, labels)
+        if changed <= tolerance * n:
+            break
+    return labels
+
+
+################################################################################
+### Centrality Utils                                                         ###
+################################################################################
+
+def adjacency(nodes, src, dst):
+    #Symmetric CSR adjacency matrix over positions in the sorted node ids `nodes`, without self loops.
+    from scipy.sparse import csr_matrix
+    n = len(nodes)
+    src, dst = np.searchsorted(nodes, src), np.searchsorted(nodes, dst)
+    loop = src == dst
+    src, dst = src[~loop], dst[~loop]
+    ones = np.ones(2 * len(src), dtype=np.float64)
+    return csr_matrix((ones, (np.concatenate([src, dst]), np.concatenate([dst, src]))), shape=(n, n))
+
+def centralities(nodes, src, dst, budget=1.0, seed=0):
+    #Degree, betweenness and eigenvector centrality of each of the sorted node
+    #ids `nodes`, given the edges src[k]-dst[k] among them, normalized as in
+    #networkx. Betweenness is estimated from as many randomly chosen sources as
+    #fit into `budget` seconds, and exact if all nodes fit.
+    #Returns a dict of arrays and the number of sources used.
+    A = adjacency(nodes, src, dst)
+    n = len(nodes)
+    degree = np.diff(A.indptr).astype(float)
+    betweenness, sources = sampled_betweenness(A, budget, seed)
+    return {
+        'degree': degree / (n - 1) if n > 1 else np.ones(n),
+        'betweenness': betweenness,
+        'eigenvector': eigenvector_centrality(A),
+    }, sources
+
+def sampled_betweenness(A, budget=1.0, seed=0):
+    #Brandes' algorithm from random sources until the time budget is spent.
+    #Every breadth first search is vectorized level by level, so a source costs
+    #a few numpy calls per level instead of Python work per edge.
+    n = A.shape[0]
+    betweenness = np.zeros(n)
+    deadline = time.perf_counter() + budget
+    sources = 0
+    for s in np.random.default_rng(seed).permutation(n):
+        if sources and time.perf_counter() > deadline:
+            break
+        sources += 1
+        dist = np.full(n, -1, dtype=np.int64)
+        sigma = np.zeros(n)
+        dist[s], sigma[s] = 0, 1
+        frontier, depth, tree = np.array([s]), 0, []
+        while len(frontier):
+            # edges from the frontier to the next level are on shortest paths
+            w = gather(A.indptr, A.indices, frontier)
+            v = np.repeat(frontier, A.indptr[frontier + 1] - A.indptr[frontier])
+            new = dist[w] < 0
+            dist[w[new]] = depth + 1
+            on_path = dist[w] == depth + 1
+            v, w = v[on_path], w[on_path]
+            sigma += np.bincount(w, weights=sigma[v], minlength=n)
+            tree.append((v, w))
+            frontier = np.unique(w)
+            depth += 1
+        delta = np.zeros(n)
+        for v, w in reversed(tree):
+            delta += np.bincount(v, weights=sigma[v] / sigma[w] * (1 + delta[w]), minlength=n)
+        delta[s] = 0
+        betweenness += delta
+    # every pair is counted from both ends, like networkx's normalization
+    if n > 2:
+        betweenness *= n / sources / ((n - 1) * (n - 2))
+    return betweenness, sources
+
+def eigenvector_centrality(A):
+    #Entries of the leading eigenvector of the adjacency matrix, with unit length.
+    n = A.shape[0]
+    if A.nnz == 0:
+        return np.full(n, 1 / np.sqrt(n)) if n else np.zeros(0)
+    if n < 100:
+        _, vectors = np.linalg.eigh(A.toarray())
+        vector = vectors[:, -1]
+    else:
+        from scipy.sparse.linalg import eigsh, ArpackNoConvergence
+        try:
+            _, vectors = eigsh(A, k=1, which='LA')
+        except ArpackNoConvergence:
+            return np.full(n, np.nan)
+        vector = vectors[:, 0]
+    vector = np.abs(vector)
+    return vector / np.linalg.norm(vector)
+
+
+################################################################################
+### Label Utils                                                              ###
+################################################################################
+
+class LabelTable:
+    """
+    Interns feature labels as dense integer ids.
+
+    Nodes of the graph are ids, i.e. positions in `names`, and every matrix,
+    metadata frame and presence/absence table is reindexed to this order when
+    loaded, so row i of any of them belongs to node i. Labels are only looked
+    up where they are shown in the browser or written to a file.
+    """
+    def __init__(self, labels):
+        self.index = pd.Index(labels)
+        if not self.index.is_unique:
+            raise ValueError('Feature labels are not unique.')
+        self.names = list(self.index)
+        self._ids = {label: i for i, label in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, label):
+        return label in self._ids
+
+    def id(self, label):
+        return self._ids[label]
+
+    def ids(self, labels):
+        #Ids of the given labels, skipping unknown ones.
+        return [self._ids[label] for label in labels if label in self._ids]
+
+    def labels(self, ids):
+        return [self.names[i] for i in ids]
+
+    def align(self, frame, rows=True, columns=False):
+        #Reorders the rows and/or columns of a frame to id order, matching them by label.
+        if rows and not frame.index.equals(self.index):
+            frame = frame.reindex(index=self.index)
+        if columns and not frame.columns.equals(self.index):
+            frame = frame.reindex(columns=self.index)
+        return frame
+
+    def relabel(self, G):
+        #Copy of a graph with labels instead of ids as nodes, e.g. for export.
+        return nx.relabel_nodes(G, {node: self.names[node] for node in G.nodes})
+
+################################################################################
+### Search Utils                                                             ###
+################################################################################
+
+class LabelIndex:
+    """
+    Case-insensitive prefix and substring search over node labels.
+
+    Prefix matches come first, in alphabetical order, followed by labels
+    containing the query elsewhere, in their original order.
+    """
+    def __init__(self, labels):
+        self.labels = list(labels)
+        lowered = [str(label).lower() for label in self.labels]
+        self._order = sorted(range(len(lowered)), key=lowered.__getitem__)
+        self._sorted = [lowered[i] for i in self._order]
+        # All labels in one string so substring search runs in C (str.find).
+        # _starts holds the offset of each label in that string.
+        self._text = '\n'.join(lowered)
+        self._starts = []
+        offset = 0
+        for label in lowered:
+            self._starts.append(offset)
+            offset += len(label) + 1
+
+    def __len__(self):
+        return len(self.labels)
+
+    def search(self, query, limit=50):
+        query = (query or '').lower()
+        if not query:
+            return [self.labels[i] for i in self._order[:limit]]
+        found = []
+        seen = set()
+        i = bisect_left(self._sorted, query)
+        while i < len(self._sorted) and self._sorted[i].startswith(query) and len(found) < limit:
+            found.append(self._order[i])
+            seen.add(self._order[i])
+            i += 1
+        pos = self._text.find(query)
+        while pos != -1 and len(found) < limit:
+            i = bisect_right(self._starts, pos) - 1
+            if i not in seen:
+                found.append(i)
+                seen.add(i)
+            # continue with the next label
+            if i + 1 == len(self._starts):
+                break
+            pos = self._text.find(query, self._starts[i + 1])
+        return [self.labels[i] for i in found]
+
 
 ################################################################################
 ### Parsing Utils                                                            ###
@@ -129,74 +856,557 @@ def parse_samplesheet(path):
 
     return meta_files, distance_files, tree_file, pa_file
 
+def data_fingerprint(path):
+    #Identifies the current version of the input data.
+    #Changes whenever the sample sheet or any file it lists is modified,
+    #so cached results computed from older data are never reused.
+    digest = hashlib.md5()
+    with open(path, 'rb') as fh:
+        digest.update(fh.read())
+    df = pd.read_table(path, sep=',')
+    for file in df['filepath']:
+        stat = os.stat(file)
+        digest.update('{0}:{1}:{2}'.format(file, stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+def file_stamps(path):
+    #Size and modification time of the sample sheet and every file it lists, to notice changes.
+    files = [path] + list(pd.read_table(path, sep=',')['filepath'])
+    return {file: (os.stat(file).st_size, os.stat(file).st_mtime_ns) for file in files}
+
+def read_labels(path):
+    #Header and first column of a csv file, without parsing any of the values.
+    #Rows are located with mmap.find, so a large matrix is scanned in milliseconds.
+    with open(path, 'rb') as fh:
+        header = next(csv.reader([fh.readline().decode()]), [])
+        pos = fh.tell()
+        if os.fstat(fh.fileno()).st_size <= pos:
+            return header, []
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            index = []
+            size = len(mm)
+            while pos < size:
+                end = mm.find(b'\n', pos)
+                if end < 0:
+                    end = size
+                if mm[pos:pos + 1] == b'"':
+                    # quoted label, possibly containing commas
+                    label = next(csv.reader([mm[pos:end].decode()]))[0]
+                else:
+                    comma = mm.find(b',', pos, end)
+                    label = mm[pos:comma if comma >= 0 else end].rstrip(b'\r').decode()
+                if end > pos + 1 or label:
+                    index.append(label)
+                pos = end + 1
+    return header, index
+
+def describe_labels(labels, n=3):
+    return ', '.join("'{}'".format(label) for label in list(labels)[:n]) + (', ...' if len(labels) > n else '')
+
+def label_difference(labels, reference):
+    #How a list of labels differs from a reference list, or None if both hold the
+    #same labels. Order does not matter, tables are aligned by label when loaded.
+    if labels == reference:
+        return None
+    in_labels, in_reference = set(labels), set(reference)
+    missing = [label for label in reference if label not in in_labels]
+    extra = [label for label in labels if label not in in_reference]
+    if missing or extra:
+        parts = []
+        if missing:
+            parts.append('{0} missing ({1})'.format(len(missing), describe_labels(missing)))
+        if extra:
+            parts.append('{0} unexpected ({1})'.format(len(extra), describe_labels(extra)))
+        return ' and '.join(parts)
+    if len(labels) != len(reference):
+        return '{0} labels instead of {1}'.format(len(labels), len(reference))
+    return None
+
+def check_inputs(meta_files, distance_files, pa_file):
+    #Checks that all tables describe the same features, in any order, before any of
+    #them is loaded. Only headers and first columns are read. Raises a
+    #SamplesheetError listing every problem.
+    problems = []
+    reference, reference_name = None, None
+
+    def check(name, labels, what):
+        nonlocal reference, reference_name
+        duplicates = [label for label, count in Counter(labels).items() if count > 1]
+        if duplicates:
+            problems.append('{0}: duplicate {1} ({2})'.format(name, what, describe_labels(duplicates)))
+        if reference is None:
+            reference, reference_name = labels, name
+            return
+        difference = label_difference(labels, reference)
+        if difference:
+            problems.append('{0}: {1} do not match the features of {2}: {3}'.format(name, what, reference_name, difference))
+
+    for label, path in distance_files:
+        name = "distance matrix '{0}' ({1})".format(label, path)
+        header, index = read_labels(path)
+        columns = header[1:]
+        if len(index) != len(columns):
+            problems.append('{0}: not square, {1} rows and {2} columns'.format(name, len(index), len(columns)))
+        else:
+            difference = label_difference(index, columns)
+            if difference:
+                problems.append('{0}: row labels do not match the column labels: {1}'.format(name, difference))
+        check(name, columns, 'column labels')
+    if pa_file is not None:
+        name = "presence/absence table ({})".format(pa_file[1])
+        header, index = read_labels(pa_file[1])
+        check(name, header[1:], 'column labels')
+        duplicates = [label for label, count in Counter(index).items() if count > 1]
+        if duplicates:
+            problems.append('{0}: duplicate sample names ({1})'.format(name, describe_labels(duplicates)))
+    for label, path in meta_files:
+        name = "metadata '{0}' ({1})".format(label, path)
+        header, index = read_labels(path)
+        check(name, index, 'row labels')
+    if problems:
+        raise SamplesheetError('Invalid input files:\n' + '\n'.join(problems))
+
 ################################################################################
 ### Formatting Utils                                                         ###
 ################################################################################
-def make_graph(meta_files, distance_files):
+def make_graph(meta_files, distance_files, edges=None):
+    #Graph over node ids 0..n-1 with the edges of an EdgeTable (built from the
+    #distance matrices if not given) and the value of every matrix as edge attributes.
+    if edges is None:
+        edges = make_edge_table(distance_files)
     G = nx.Graph()
-    #add edges first
-    edge_dfs = []
-    edge_attrs = []
-    for tup in distance_files:
-        edge_attrs.append(tup[0])
-        edge_dfs.append(tup[1])
-
-    # Make sure the dfs are all same shapes
-    assert len(list(set([df.shape[0] for df in edge_dfs]))) == 1
-    assert len(list(set([df.shape[1] for df in edge_dfs]))) == 1
-
-    stacked = [frame.where(np.triu(np.ones(frame.shape)).astype(np.bool)).stack() for frame in edge_dfs]
-    pairs = stacked[0].index
     print("Constructing nodes. . .")
-    nodes = list(edge_dfs[0].columns)
-
-    for node in tqdm(nodes):
-        G.add_node(node)
+    G.add_nodes_from(range(edges.n_nodes))
 
     print("Constructing edges. . .")
-    #edges = []
-    data = list(zip(edge_attrs, stacked))
-    edge_dict = {k: dict() for k in pairs}
-    for tup in tqdm(pairs):
-        for attribute, df in data:
-            edge_dict[tup][attribute] = df.loc[tup]
-
-    edges = [(*k, v) for k, v in edge_dict.items()]
-    G.add_edges_from(edges)
+    attrs = edges.attributes
+    values = [edges.values[attr].tolist() for attr in attrs]
+    G.add_edges_from(zip(edges.src.tolist(), edges.dst.tolist(), (dict(zip(attrs, vals)) for vals in zip(*values))))
     #Need to add the metadata...
 
     return G
 
+# Matrices are parsed as float32: half the memory of float64, and plenty of
+# precision for p-values, likelihood ratios and correlations.
+MATRIX_DTYPE = np.float32
+
+def read_header(path):
+    #Column names of a csv file, without reading the rest of it.
+    with open(path, newline='') as fh:
+        return next(csv.reader(fh), [])
+
+def read_matrix(path):
+    #Table with labels in the first column and numbers in all others, e.g. a
+    #distance matrix or presence/absence table. Values are read as MATRIX_DTYPE.
+    header = read_header(path)
+    # pyarrow parses blocks of a file on several threads, but on a single core
+    # pandas' own parser is faster.
+    if (os.cpu_count() or 1) > 1:
+        try:
+            return read_matrix_arrow(path, header)
+        except ImportError:
+            pass
+    dtype = {column: MATRIX_DTYPE for column in header[1:]}
+    dtype[header[0]] = str
+    return pd.read_csv(path, index_col=0, dtype=dtype)
+
+def read_matrix_arrow(path, header):
+    import pyarrow
+    import pyarrow.csv
+    types = {column: pyarrow.from_numpy_dtype(MATRIX_DTYPE) for column in header[1:]}
+    types[header[0]] = pyarrow.string()
+    table = pyarrow.csv.read_csv(path, convert_options=pyarrow.csv.ConvertOptions(column_types=types))
+    values = np.empty((table.num_rows, table.num_columns - 1), dtype=MATRIX_DTYPE)
+    for i, column in enumerate(table.columns[1:]):
+        values[:, i] = column.to_numpy()
+    index = pd.Index(table.column(0).to_numpy(zero_copy_only=False), name=header[0] or None)
+    return pd.DataFrame(values, index=index, columns=header[1:])
+
+def read_metadata(path):
+    #Metadata are small and may hold text columns, so only the float columns are narrowed.
+    frame = pd.read_csv(path, index_col=0, dtype={read_header(path)[0]: str})
+    floats = frame.select_dtypes('float64').columns
+    return frame.astype({column: MATRIX_DTYPE for column in floats})
+
+def read_files(jobs, workers=None):
+    #Reads (label, path, reader) jobs concurrently and returns [(label, frame)] in job order.
+    #The parsers release the GIL, so threads keep several cores busy.
+    def read(job):
+        label, path, reader = job
+        start = time.perf_counter()
+        frame = reader(path)
+        seconds = time.perf_counter() - start
+        megabytes = os.path.getsize(path) / 1e6
+        print("Read {0} ({1} x {2}) in {3:.2f} s, {4:.1f} MB/s".format(
+            label, frame.shape[0], frame.shape[1], seconds, megabytes / max(seconds, 1e-9)))
+        return label, frame
+    if not jobs:
+        return []
+    workers = workers or min(len(jobs), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='indizio-read') as pool:
+        return list(pool.map(read, jobs))
+
+def pearson_matrices(pa, block_bytes=2**25):
+    #Absolute Pearson correlation of every pair of features (columns) of a
+    #presence/absence table, with two-sided p-values from the t-distribution and
+    #Benjamini-Hochberg q-values over all distinct pairs. Missing values count as
+    #absent. Computed in blocks of rows to bound the memory of intermediates;
+    #the q-values need two more copies of the upper triangle, see benjamini_hochberg.
+    from scipy.special import stdtr
+    x = pa.fillna(0).to_numpy(dtype=float)
+    n, f = x.shape
+    std = x.std(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # constant features have no correlation (NaN), as with DataFrame.corr
+        z = (x - x.mean(axis=0)) / std
+    r = np.empty((f, f), dtype=MATRIX_DTYPE)
+    p = np.empty((f, f), dtype=MATRIX_DTYPE)
+    df = n - 2
+    rows = max(1, block_bytes // (8 * f))
+    for start in range(0, f, rows):
+        block = np.clip(z[:, start:start + rows].T @ z / n, -1, 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.abs(block) * np.sqrt(df / (1 - block ** 2))
+        p[start:start + rows] = 2 * stdtr(df, -t) if df > 0 else np.nan
+        r[start:start + rows] = np.abs(block)
+    q = benjamini_hochberg(p, rows)
+    frame = lambda values: pd.DataFrame(values, index=pa.columns, columns=pa.columns)
+    return frame(r), frame(p), frame(q)
+
+def benjamini_hochberg(p, rows):
+    #Benjamini-Hochberg q-values of a symmetric matrix of p-values, over the
+    #distinct pairs (upper triangle) and written back symmetrically. Besides q
+    #at most two copies of the upper triangle in the dtype of p are held: the
+    #sorted p-values and their q-values. Tied p-values share a q-value, so
+    #both are reduced to the distinct p-values, in which blocks of `rows` rows
+    #then look up their q-values.
+    f = len(p)
+    pairs = np.empty(f * (f - 1) // 2, dtype=p.dtype)
+    missing = 0
+    offset = 0
+    for a in range(f - 1):
+        row = p[a, a + 1:]
+        pairs[offset:offset + len(row)] = row
+        missing += np.count_nonzero(np.isnan(row))
+        offset += len(row)
+    # NaN sorts last
+    pairs.sort()
+    m = len(pairs) - missing
+    ranked = pairs[:m]
+    q_sorted = np.empty(m, dtype=p.dtype)
+    chunk = max(1, rows * f)
+    carry = np.inf
+    # the running minimum from the largest p-value down, in chunks to bound the temporaries
+    for stop in range(m, 0, -chunk):
+        start = max(0, stop - chunk)
+        values = ranked[start:stop] * (m / np.arange(start + 1, stop + 1))
+        values = np.minimum(np.minimum.accumulate(values[::-1])[::-1], carry)
+        carry = values[0]
+        q_sorted[start:stop] = np.minimum(values, 1)
+    # keeps the last of every run of equal p-values, in place
+    distinct = 0
+    for start in range(0, m, chunk):
+        stop = min(m, start + chunk)
+        last = np.append(ranked[start + 1:stop] != ranked[start:stop - 1], True)
+        if stop < m:
+            last[-1] = ranked[stop - 1] != ranked[stop]
+        k = np.count_nonzero(last)
+        ranked[distinct:distinct + k], q_sorted[distinct:distinct + k] = ranked[start:stop][last], q_sorted[start:stop][last]
+        distinct += k
+    ranked, q_sorted = ranked[:distinct], q_sorted[:distinct]
+    q = np.empty((f, f), dtype=p.dtype)
+    for start in range(0, f, rows):
+        stop = min(f, start + rows)
+        block = p[start:stop, start:]
+        # the lower half of the square on the diagonal has no exact match, it is overwritten below
+        index = np.minimum(np.searchsorted(ranked, block), distinct - 1)
+        q[start:stop, start:] = np.where(np.isnan(block), np.nan, q_sorted[index] if distinct else np.nan)
+        # the lower triangle mirrors the upper one, the diagonal keeps the p-values
+        square = q[start:stop, start:stop]
+        square[:] = np.triu(square, 1) + np.triu(square, 1).T
+        np.fill_diagonal(square, np.diag(p)[start:stop])
+        q[start:stop, :start] = q[:start, start:stop].T
+    return q
+
 #the big one.
-def initialize_data(path):
+def initialize_data(path, workers=None):
     m, d, t, p = parse_samplesheet(path)
-    pa = None
+    start = time.perf_counter()
+    check_inputs(m, d, p)
+    print("Checked input files in {:.2f} s".format(time.perf_counter() - start))
+    jobs = []
     if type(p) != type(None):
         print("pa matrix found")
-        pa = pd.read_table(p[1], sep=',', dtype=str)
-        pa.set_index(pa.columns[0], inplace=True)
-        pa = pa.astype(float)
+        jobs.append(('P', p[1], read_matrix))
+    if type(d) != type(None):
+        jobs.extend(('DM', tup[1], read_matrix) for tup in d)
+    if type(m) != type(None):
+        jobs.extend(('M', tup[1], read_metadata) for tup in m)
+    start = time.perf_counter()
+    frames = read_files([('{0} {1}'.format(kind, os.path.basename(file)), file, reader) for kind, file, reader in jobs], workers)
+    print("Read {0} files in {1:.2f} s".format(len(frames), time.perf_counter() - start))
+    frames = iter(frame for _, frame in frames)
 
+    pa = None
+    if type(p) != type(None):
+        pa = next(frames)
     dms = []
     if type(d) != type(None):
         for tup in d:
-            dms.append((tup[0], pd.read_table(tup[1], sep=',', index_col=0)))
+            dms.append((tup[0], next(frames)))
     # if there is a pa matrix but no DM, we need to make a DM.
     if len(dms)==0:
         print("pearson")
-        dms.append(('(abs) pearson', pa.corr().abs()))
+        r, p_values, q_values = pearson_matrices(pa)
+        # p- and q-values become edge attributes too, to threshold on significance.
+        dms += [('(abs) pearson', r), ('pearson p', p_values), ('pearson q', q_values)]
 
+    metas = []
     if type(m) != type(None):
-        metas = []
         for tup in m:
-            metas.append((tup[0], pd.read_table(tup[1], sep=',', index_col=0)))
+            metas.append((tup[0], next(frames)))
+
+    # One label order for everything, so tables listing the features in a
+    # different order line up by position.
+    labels = LabelTable(dms[0][1].columns)
+    dms = [(attr, labels.align(frame, rows=True, columns=True)) for attr, frame in dms]
+    metas = [(attr, labels.align(frame)) for attr, frame in metas]
+    if pa is not None:
+        pa = labels.align(pa, rows=False, columns=True)
     tree = None
     if type(t) != type(None):
-        #load the tree
-        pass
+        print("tree found")
+        tree = read_newick(t[1])
+
+    return metas, dms, pa, tree, labels
+
+def reload_data(path, metas, dms, pa, tree, labels, changed, workers=None):
+    #Re-reads only the files in `changed` into data loaded by initialize_data.
+    #Returns the new metas, dms, pa and tree and the names of the distance
+    #matrices whose values changed, or None if everything must be loaded again
+    #because the sample sheet itself or the set of features changed.
+    if path in changed:
+        return None
+    m, d, t, p = parse_samplesheet(path)
+    check_inputs(m, d, p)
+    header, _ = read_labels(d[0][1] if len(d) else p[1])
+    if label_difference(header[1:], labels.names):
+        return None
+    jobs = [('DM', label, file, read_matrix) for label, file in d]
+    jobs += [('M', label, file, read_metadata) for label, file in m]
+    if p is not None:
+        jobs.append(('P', p[0], p[1], read_matrix))
+    jobs = [job for job in jobs if job[2] in changed]
+    frames = read_files([('{0} {1}'.format(kind, os.path.basename(file)), file, reader) for kind, _, file, reader in jobs], workers)
+    new = {(kind, label): frame for (kind, label, _, _), (_, frame) in zip(jobs, frames)}
+
+    updated = [attr for attr, _ in dms if ('DM', attr) in new]
+    dms = [(attr, labels.align(new[('DM', attr)], rows=True, columns=True)) if attr in updated else (attr, frame)
+           for attr, frame in dms]
+    metas = [(attr, labels.align(new[('M', attr)])) if ('M', attr) in new else (attr, frame)
+             for attr, frame in metas]
+    if p is not None and ('P', p[0]) in new:
+        pa = labels.align(new[('P', p[0])], rows=False, columns=True)
+        if len(d) == 0:
+            # The matrices were computed from the presence/absence table.
+            dms = list(zip([attr for attr, _ in dms], pearson_matrices(pa)))
+            updated = [attr for attr, _ in dms]
+    if t is not None and t[1] in changed:
+        tree = read_newick(t[1])
+    return metas, dms, pa, tree, updated
+
+
+################################################################################
+### Clustering Utils                                                         ###
+################################################################################
+# Above this many features the pairwise distances of the linkage no longer fit
+# comfortably in memory, so matrices are shown in file order.
+MAX_CLUSTER_FEATURES = 15000
+
+def frame_fingerprint(frame):
+    #Content hash of a data frame, for caching results computed from it.
+    digest = hashlib.md5()
+    digest.update('\n'.join(map(str, frame.index)).encode())
+    digest.update('\n'.join(map(str, frame.columns)).encode())
+    digest.update(np.ascontiguousarray(frame.values).tobytes())
+    return digest.hexdigest()
+
+def cluster_order(frame):
+    #Average linkage clustering of the rows of a matrix.
+    #Returns the linkage matrix and the leaf order as row positions.
+    from scipy.cluster.hierarchy import linkage, leaves_list
+    values = frame.values.astype(float)
+    if values.shape[0] < 2:
+        return None, np.arange(values.shape[0])
+    # Missing values would make every distance involving them NaN.
+    col_means = np.nan_to_num(np.nanmean(values, axis=0))
+    values = np.where(np.isnan(values), col_means, values)
+    Z = linkage(values, method='average', metric='euclidean')
+    return Z, leaves_list(Z)
+
+def reorder(feature_df, meta_df, order, subset=None):
+    #Applies a row order to a (square) distance matrix and its metadata, keeping
+    #only the features at the positions in `subset` if given. One indexed take
+    #of the stored values, cheap enough to do on every render.
+    if order is None and subset is None:
+        return feature_df, meta_df
+    positions = np.arange(feature_df.shape[0]) if order is None else np.asarray(order)
+    if subset is not None:
+        keep = np.zeros(feature_df.shape[0], dtype=bool)
+        keep[subset] = True
+        positions = positions[keep[positions]]
+    feature_df = pd.DataFrame(feature_df.to_numpy()[np.ix_(positions, positions)],
+                              index=feature_df.index[positions], columns=feature_df.columns[positions])
+    if meta_df is not None:
+        # metadata rows are aligned to the matrix rows when loaded
+        meta_df = meta_df.iloc[positions]
+    return feature_df, meta_df
+
+################################################################################
+### Plotting Utils                                                           ###
+################################################################################
+# Heatmaps with more rows or columns than this are drawn as block averages.
+MAX_HEATMAP_SIZE = 1000
+
+def n_blocks(n, max_size=MAX_HEATMAP_SIZE):
+    #Size of the runs of rows (or columns) averaged into one heatmap cell.
+    return max(1, -(-n // max_size))
+
+def downsample_frame(frame, max_rows=MAX_HEATMAP_SIZE, max_cols=MAX_HEATMAP_SIZE):
+    #Averages runs of consecutive rows and columns so at most max_rows x max_cols
+    #cells are left. Each block is labelled by its first row/column.
+    rb = n_blocks(frame.shape[0], max_rows)
+    cb = n_blocks(frame.shape[1], max_cols)
+    if rb == 1 and cb == 1:
+        return frame
+    nr = -(-frame.shape[0] // rb)
+    nc = -(-frame.shape[1] // cb)
+    values = np.full((nr * rb, nc * cb), np.nan)
+    values[:frame.shape[0], :frame.shape[1]] = frame.values
+    with warnings.catch_warnings():
+        # blocks of only missing values stay missing
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        values = np.nanmean(values.reshape(nr, rb, nc, cb), axis=(1, 3))
+    return pd.DataFrame(values, index=frame.index[::rb], columns=frame.columns[::cb])
+
+def make_heatmap_figure(feature_df, meta_df, colorscale, zmin, zmax):
+    #Heatmap of a distance matrix, with its metadata as a narrow heatmap on the left.
+    import plotly.graph_objects as go
+    feature_df = downsample_frame(feature_df)
+    if meta_df is not None:
+        meta_df = downsample_frame(meta_df, max_cols=meta_df.shape[1])
+    fig = go.Figure()
+    ava_hm = go.Heatmap(x=feature_df.columns,
+                        y=feature_df.index,
+                        z=feature_df,
+                        colorscale=colorscale,
+                        zmin=zmin,
+                        zmax=zmax,
+                        #colorbar=colorbar,
+                       )
+    if type(meta_df) != type(None):
+        meta_hm = go.Heatmap(x=meta_df.columns,
+                             y=meta_df.index,
+                             z=meta_df,
+                             colorscale=colorscale,
+                             zmin=zmin,
+                             zmax=zmax,
+                             showscale=False
+        )
+        f1 = go.Figure(meta_hm)
+        for data in f1.data:
+            fig.add_trace(data)
+
+        f2 = go.Figure(ava_hm)
+        for i in range(len(f2['data'])):
+            f2['data'][i]['xaxis'] = 'x2'
+
+        for data in f2.data:
+            fig.add_trace(data)
+
+        fig.update_layout({'height':800})
+        fig.update_layout(xaxis={'domain': [.0, .20],
+                                          'mirror': False,
+                                          'showgrid': False,
+                                          'showline': False,
+                                          'zeroline': False,
+                                          #'ticks':"",
+                                          #'showticklabels': False
+                                })
+        # Edit xaxis2
+        fig.update_layout(xaxis2={'domain': [0.25, 1.0],
+                                           'mirror': False,
+                                           'showgrid': False,
+                                           'showline': False,
+                                           'zeroline': False,
+                                           #'showticklabels': False,
+                                           #'ticks':""
+                                 })
+    else:
+        f = go.Figure(ava_hm)
+        for data in f.data:
+            fig.add_trace(data)
+        fig.update_layout({'height':800})
+        fig.update_layout(xaxis={'mirror': False,
+                                 'showgrid': False,
+                                 'showline': False,
+                                 'zeroline': False,
+                                 'tickmode': 'array',
+                                 'ticktext': feature_df.columns.str.slice(-8).tolist()})
+    return fig
+
+
+def make_percolation_figure(curve, attribute):
+    #Component count, largest component and edge count against the threshold.
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    panels = [('n_components', 'Components'), ('largest_component', 'Largest component (nodes)'), ('n_edges', 'Edges')]
+    fig = make_subplots(rows=len(panels), cols=1, shared_xaxes=True, vertical_spacing=0.04,
+                        subplot_titles=[title for _, title in panels])
+    for i, (column, title) in enumerate(panels):
+        fig.add_trace(go.Scattergl(x=curve['threshold'], y=curve[column], mode='lines',
+                                   line={'shape': 'hv'}, name=title), row=i + 1, col=1)
+    thresholds = curve['threshold']
+    # p-value like attributes span many orders of magnitude
+    if len(thresholds) and thresholds.min() > 0 and thresholds.max() / thresholds.min() > 1e3:
+        fig.update_xaxes(type='log')
+    fig.update_xaxes(title_text='{} threshold'.format(attribute), row=len(panels), col=1)
+    fig.update_layout({'height': 800, 'showlegend': False})
+    return fig
 
-    return metas, dms, pa, tree
+def make_clustergram_figure(tree, pa, colorscale):
+    #Dendrogram of the tree next to the presence/absence table, whose rows are
+    #put in the order of the tree leaves.
+    import plotly.graph_objects as go
+    leaf_names = tree.leaf_names
+    rows = pa.reindex(leaf_names)
+    x, y = dendrogram_lines(tree)
+    binned = downsample_frame(rows)
+    # centre of each block of leaves, in the dendrogram's leaf coordinates
+    rb = n_blocks(len(rows))
+    starts = np.arange(len(binned)) * rb
+    centres = (starts + np.minimum(starts + rb, len(rows)) - 1) / 2
 
+    fig = go.Figure()
+    fig.add_trace(go.Scattergl(x=x, y=y, mode='lines', line={'color': '#444', 'width': 1},
+                               hoverinfo='skip', showlegend=False))
+    fig.add_trace(go.Heatmap(x=binned.columns, y=centres, z=binned.values,
+                             colorscale=colorscale, xaxis='x2',
+                             text=np.array(binned.index)[:, None].repeat(binned.shape[1], axis=1),
+                             hovertemplate='%{text}<br>%{x}: %{z}<extra></extra>'))
+    yaxis = {'showgrid': False, 'zeroline': False, 'range': [-0.5, len(rows) - 0.5]}
+    if len(rows) <= 200:
+        yaxis.update({'tickmode': 'array', 'tickvals': list(range(len(rows))), 'ticktext': leaf_names})
+    else:
+        yaxis['showticklabels'] = False
+    fig.update_layout({'height': 800},
+                      xaxis={'domain': [0, 0.25], 'showgrid': False, 'zeroline': False, 'showticklabels': False},
+                      xaxis2={'domain': [0.27, 1.0], 'showgrid': False, 'zeroline': False},
+                      yaxis=yaxis)
+    missing = rows.isna().all(axis=1).sum()
+    if missing:
+        fig.update_layout(title='{} tree leaves are not in the presence/absence table.'.format(missing))
+    return fig
 
 ################################################################################
 ## These two color functions from                                             ##
@@ -234,6 +1444,7 @@ def get_continuous_color(colorscale, intermed):
     :return: color in rgb string format
     :rtype: str
     """
+    from PIL import ImageColor
     if len(colorscale) < 1:
         raise ValueError("colorscale must have at least one color")
 